@@ -0,0 +1,56 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import heapq
+import typing
+
+from migration_records import DiskClone
+
+# Rough clone speed of every disk type. It is only used to order the clones
+# and to predict when the clone phase finishes, so relative values matter most.
+CLONE_SECONDS_PER_GB = {
+    "pd-standard": 2.0,
+    "pd-balanced": 1.0,
+    "pd-ssd": 0.5,
+    "pd-extreme": 0.5,
+}
+DEFAULT_CLONE_SECONDS_PER_GB = 2.0
+CLONE_OPERATION_OVERHEAD_SECONDS = 10
+
+
+def estimate_clone_seconds(size_gb: int, disk_type: str) -> float:
+    seconds_per_gb = CLONE_SECONDS_PER_GB.get(disk_type, DEFAULT_CLONE_SECONDS_PER_GB)
+
+    return CLONE_OPERATION_OVERHEAD_SECONDS + size_gb * seconds_per_gb
+
+
+def plan_longest_job_first(
+    jobs: typing.List[DiskClone], workers: int
+) -> typing.Tuple[typing.List[DiskClone], float]:
+    # LPT (longest processing time first) rule: workers pick up the longest
+    # remaining clone, so the biggest disks never start at the end of the run.
+    # Every job gets the predicted number of seconds from the start of the clone
+    # phase until it finishes, and the predicted duration of the phase is returned.
+    ordered_jobs = sorted(jobs, key=lambda job: job.estimated_seconds, reverse=True)
+
+    # Every item is the time when a worker becomes free
+    worker_free_times = [0.0] * max(1, min(workers, len(ordered_jobs)))
+    predicted_duration = 0.0
+
+    for job in ordered_jobs:
+        start_time = heapq.heappop(worker_free_times)
+        job.predicted_finish = start_time + job.estimated_seconds
+        heapq.heappush(worker_free_times, job.predicted_finish)
+        predicted_duration = max(predicted_duration, job.predicted_finish)
+
+    return ordered_jobs, predicted_duration
@@ -0,0 +1,187 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import concurrent.futures
+import threading
+import time
+import typing
+
+from migration_progress import locked_print
+
+# An operation slower than this multiple of the baseline latency means the
+# project is getting busy, and the limit is cut down
+LATENCY_TOLERANCE = 2.0
+# Weight of a new healthy latency sample in the baseline latency
+BASELINE_WEIGHT = 0.2
+DECREASE_FACTOR = 0.5
+
+
+class AdaptiveConcurrencyLimiter:
+    # AIMD (additive increase, multiplicative decrease) limit of operations that
+    # run at the same time. While operation latencies stay close to the baseline,
+    # the limit grows by one for every full window of successful operations.
+    # A slow or failed operation halves the limit, at most once per baseline latency,
+    # so a single burst of slow operations doesn't collapse the limit to the minimum.
+
+    def __init__(self, name: str, max_limit: int, min_limit: int = 1) -> None:
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = float(self.initial_limit(max_limit, min_limit))
+        # Every item is the number of seconds since the start and the new limit
+        self.history = [(0.0, int(self.limit))]
+
+        self._active = 0
+        # Latency per unit of cost, to compare operations of different sizes
+        self._baseline_latency = None
+        # Latency in seconds, to limit how often the limit is cut down
+        self._baseline_raw_latency = None
+        self._last_decrease_time = 0.0
+        self._start_time = time.time()
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def initial_limit(max_limit: int, min_limit: int = 1) -> int:
+        return max(min_limit, max(min_limit, max_limit) // 2)
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self._active >= int(self.limit):
+                self._condition.wait()
+            self._active += 1
+
+    def release(self) -> None:
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def record_latency(self, raw_latency: float, cost: float = 1.0) -> None:
+        # Operations of different sizes are compared by their latency per unit of cost
+        latency = raw_latency / cost
+
+        with self._condition:
+            if self._baseline_latency is None:
+                self._baseline_latency = latency
+                self._baseline_raw_latency = raw_latency
+
+            if latency > self._baseline_latency * LATENCY_TOLERANCE:
+                self._decrease(
+                    f"latency {latency:.1f}s is above baseline {self._baseline_latency:.1f}s"
+                )
+                return
+
+            self._baseline_latency += BASELINE_WEIGHT * (
+                latency - self._baseline_latency
+            )
+            self._baseline_raw_latency += BASELINE_WEIGHT * (
+                raw_latency - self._baseline_raw_latency
+            )
+            self._set_limit(
+                min(self.max_limit, self.limit + 1 / int(self.limit)), "latency is flat"
+            )
+
+    def record_error(self, error: Exception) -> None:
+        with self._condition:
+            self._decrease(f"operation failed: {error}")
+
+    def _decrease(self, reason: str) -> None:
+        # Must be called with the condition held
+        now = time.time()
+
+        # Operations that started before the last decrease still ran with the
+        # old limit, so they don't cause another one. The window is measured
+        # in seconds, so it uses the latency that isn't divided by the cost.
+        if now - self._last_decrease_time < (self._baseline_raw_latency or 0):
+            return
+
+        self._last_decrease_time = now
+        self._set_limit(max(self.min_limit, self.limit * DECREASE_FACTOR), reason)
+
+    def _set_limit(self, limit: float, reason: str) -> None:
+        # Must be called with the condition held
+        previous_limit = int(self.limit)
+        self.limit = limit
+
+        if int(limit) != previous_limit:
+            elapsed = time.time() - self._start_time
+            self.history.append((elapsed, int(limit)))
+            locked_print(
+                f"Concurrency of {self.name} changed from {previous_limit} to {int(limit)} ({reason})"
+            )
+            self._condition.notify_all()
+
+    def format_history(self) -> str:
+        return ", ".join(
+            f"{limit} at {int(elapsed)}s" for elapsed, limit in self.history
+        )
+
+
+class RateLimiter:
+    # Token bucket: lets through bursts of up to `burst` operations, and on
+    # average no more than `rate` operations per second
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+
+        self._tokens = float(self.burst)
+        self._last_refill_time = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last_refill_time) * self.rate,
+            )
+            self._last_refill_time = now
+
+            # The token is taken right away. If the bucket is empty, the caller
+            # waits until the token it took has been refilled.
+            self._tokens -= 1
+            delay = max(0.0, -self._tokens / self.rate)
+
+        if delay:
+            time.sleep(delay)
+
+
+def run_with_limiter(
+    limiter: AdaptiveConcurrencyLimiter,
+    function: typing.Callable[[typing.Any], typing.Any],
+    items: typing.Iterable[typing.Any],
+    executor: concurrent.futures.Executor,
+) -> typing.List[concurrent.futures.Future]:
+    # Items are started strictly in the given order, each as soon as the limiter
+    # has a free slot. Nothing new is started after one of the items has failed.
+    futures = []
+    failed = threading.Event()
+
+    def run_item(item: typing.Any) -> typing.Any:
+        try:
+            return function(item)
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            limiter.release()
+
+    for item in items:
+        limiter.acquire()
+
+        if failed.is_set():
+            limiter.release()
+            break
+
+        futures.append(executor.submit(run_item, item))
+
+    return futures
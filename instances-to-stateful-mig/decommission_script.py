@@ -0,0 +1,76 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import sys
+
+from stateful_mig_migrator import StatefulMIGMigrator
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-p", "--project")
+    parser.add_argument("-s", "--source_instances", nargs="+", default=[])
+    parser.add_argument("-z", "--source_instance_zone", required=True)
+    parser.add_argument("-m", "--mig_name", required=True)
+
+    parser.add_argument(
+        "--regional", dest="regional", action="store_true", default=False,
+    )
+
+    parser.add_argument(
+        "--snapshot_disks", dest="snapshot_disks", action="store_true", default=False,
+    )
+
+    parser.add_argument("--delete_workers", type=int, default=16)
+    parser.add_argument("--delete_rate", type=float, default=10)
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument("--verify_workers", type=int, default=16)
+
+    # Migration settings that don't apply to the decommission
+    parser.set_defaults(
+        base_instance_name=None,
+        image_for_boot_disk=False,
+        append=False,
+        stateful_policy=False,
+        disk_rules=[],
+        stop_workers=1,
+        clone_workers=1,
+        add_workers=1,
+        progress_fd=None,
+    )
+
+    args = parser.parse_args()
+
+    if len(args.source_instances) == 0:
+        parser.error(
+            "You must provide at least one instance using --source_instances argument"
+        )
+
+    for workers_argument in ("delete_workers", "verify_workers"):
+        if getattr(args, workers_argument) < 1:
+            parser.error(f"--{workers_argument} must be at least 1")
+
+    if args.max_retries < 0:
+        parser.error("--max_retries must be at least 0")
+
+    if args.delete_rate <= 0:
+        parser.error("--delete_rate must be greater than 0")
+
+    migrator = StatefulMIGMigrator(args)
+    report = migrator.decommission(
+        args.delete_workers, args.delete_rate, args.snapshot_disks
+    )
+
+    if any(result.error for result in report.values()):
+        sys.exit(1)
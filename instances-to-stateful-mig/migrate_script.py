@@ -12,9 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import os
+import sys
 
+from migration_records import DiskRule
 from stateful_mig_migrator import StatefulMIGMigrator
 
+
+def disk_rule(value: str) -> DiskRule:
+    try:
+        return DiskRule.parse(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -35,6 +46,32 @@ if __name__ == "__main__":
         default=False,
     )
 
+    parser.add_argument(
+        "--append", dest="append", action="store_true", default=False,
+    )
+
+    parser.add_argument(
+        "--stateful_policy",
+        dest="stateful_policy",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--disk_rule", dest="disk_rules", type=disk_rule, action="append", default=[],
+    )
+
+    parser.add_argument("--stop_workers", type=int, default=8)
+    parser.add_argument("--clone_workers", type=int, default=4)
+    parser.add_argument("--add_workers", type=int, default=4)
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument("--progress_fd", type=int)
+    parser.add_argument("--verify_workers", type=int, default=16)
+
+    parser.add_argument(
+        "--verify_only", dest="verify_only", action="store_true", default=False,
+    )
+
     args = parser.parse_args()
 
     if len(args.source_instances) == 0:
@@ -42,6 +79,32 @@ if __name__ == "__main__":
             "You must provide at least one instance using --source_instances argument"
         )
 
+    for workers_argument in (
+        "stop_workers",
+        "clone_workers",
+        "add_workers",
+        "verify_workers",
+    ):
+        if getattr(args, workers_argument) < 1:
+            parser.error(f"--{workers_argument} must be at least 1")
+
+    if args.max_retries < 0:
+        parser.error("--max_retries must be at least 0")
+
+    if args.progress_fd is not None:
+        try:
+            os.fstat(args.progress_fd)
+        except OSError:
+            parser.error(
+                f"--progress_fd {args.progress_fd} is not an open file descriptor"
+            )
+
     migrator = StatefulMIGMigrator(args)
 
-    migrator.migrate()
+    if args.verify_only:
+        report = migrator.verify()
+
+        if any(report.values()):
+            sys.exit(1)
+    elif not migrator.migrate():
+        sys.exit(1)
@@ -0,0 +1,199 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import threading
+import time
+import typing
+
+# Every instance goes through three steps: stop, clone and insert into the MIG.
+# The steps are weighted by their predicted duration, so a step that finishes
+# quickly (like stopping instances that are already stopped) doesn't make the
+# ETA too low. The clone step counts as done in proportion to the GB of disk
+# cloned so far, so the progress moves while large disks are being cloned.
+STEPS = ("stop", "clone", "insert")
+
+_print_lock = threading.Lock()
+
+
+def locked_print(*lines: str) -> None:
+    # Keeps lines printed together by one worker thread from being
+    # interleaved with the output of other workers
+    with _print_lock:
+        for line in lines:
+            print(line)
+
+
+class ProgressReporter:
+    def __init__(self, total_instances: int, progress_fd: int = None) -> None:
+        self.total_instances = total_instances
+        self.stopped = 0
+        self.cloned = 0
+        self.inserted = 0
+        self.total_disk_gb = 0
+        self.cloned_disk_gb = 0
+        # Only stops of running instances take time
+        self.instances_to_stop = total_instances
+        self.running_stopped = 0
+        # Predicted duration of every step in seconds, equal until planned
+        self.step_seconds = {step: 1.0 for step in STEPS}
+
+        self._start_time = time.time()
+        self._lock = threading.Lock()
+        # Machine readable events are written as JSON lines to the given file descriptor
+        self._events = (
+            os.fdopen(progress_fd, "w", buffering=1) if progress_fd is not None else None
+        )
+
+    def _completed_fraction(self) -> float:
+        if not self.total_instances:
+            return 1.0
+
+        step_fractions = {
+            "stop": (
+                self.running_stopped / self.instances_to_stop
+                if self.instances_to_stop
+                else 1.0
+            ),
+            "clone": (
+                self.cloned_disk_gb / self.total_disk_gb
+                if self.total_disk_gb
+                else self.cloned / self.total_instances
+            ),
+            "insert": self.inserted / self.total_instances,
+        }
+        total_seconds = sum(self.step_seconds.values())
+
+        if not total_seconds:
+            return step_fractions["insert"]
+
+        return (
+            sum(self.step_seconds[step] * step_fractions[step] for step in STEPS)
+            / total_seconds
+        )
+
+    def _instances_per_minute(self) -> float:
+        elapsed_minutes = (time.time() - self._start_time) / 60
+
+        if not elapsed_minutes:
+            return 0.0
+
+        return self._completed_fraction() * self.total_instances / elapsed_minutes
+
+    def _eta_seconds(self) -> typing.Optional[float]:
+        completed_fraction = self._completed_fraction()
+
+        if not completed_fraction:
+            return None
+
+        elapsed = time.time() - self._start_time
+
+        return elapsed * (1 - completed_fraction) / completed_fraction
+
+    def _report(self, event: str, **details: typing.Any) -> None:
+        # Must be called with the lock held
+        eta_seconds = self._eta_seconds()
+        instances_per_minute = self._instances_per_minute()
+
+        if event not in ("started", "finished", "failed"):
+            eta = f"{int(eta_seconds)} seconds" if eta_seconds is not None else "unknown"
+            locked_print(
+                f"Progress: {self.stopped}/{self.total_instances} stopped, "
+                f"{self.cloned}/{self.total_instances} cloned "
+                f"({self.cloned_disk_gb}/{self.total_disk_gb} GB), "
+                f"{self.inserted}/{self.total_instances} inserted, "
+                f"{instances_per_minute:.1f} instances/min, ETA {eta}"
+            )
+
+        if self._events:
+            self._events.write(
+                json.dumps(
+                    dict(
+                        details,
+                        event=event,
+                        timestamp=time.time(),
+                        total_instances=self.total_instances,
+                        stopped=self.stopped,
+                        cloned=self.cloned,
+                        inserted=self.inserted,
+                        total_disk_gb=self.total_disk_gb,
+                        cloned_disk_gb=self.cloned_disk_gb,
+                        instances_per_minute=round(instances_per_minute, 3),
+                        eta_seconds=(
+                            round(eta_seconds) if eta_seconds is not None else None
+                        ),
+                    )
+                )
+                + "\n"
+            )
+
+    def started(self) -> None:
+        with self._lock:
+            self._report("started")
+
+    def plan(
+        self,
+        instances_to_stop: int,
+        stop_seconds: float,
+        clone_seconds: float,
+        insert_seconds: float,
+    ) -> None:
+        with self._lock:
+            self.instances_to_stop = instances_to_stop
+            self.step_seconds = {
+                "stop": stop_seconds,
+                "clone": clone_seconds,
+                "insert": insert_seconds,
+            }
+
+    def instance_stopped(self, instance_name: str, was_running: bool = True) -> None:
+        with self._lock:
+            self.stopped += 1
+
+            if was_running:
+                self.running_stopped += 1
+
+            self._report("stopped", instance=instance_name)
+
+    def add_disk_gb(self, size_gb: int) -> None:
+        with self._lock:
+            self.total_disk_gb += size_gb
+
+    def disk_cloned(self, instance_name: str, disk_name: str, size_gb: int) -> None:
+        with self._lock:
+            self.cloned_disk_gb += size_gb
+            self._report("disk_cloned", instance=instance_name, disk=disk_name)
+
+    def instance_cloned(self, instance_name: str) -> None:
+        with self._lock:
+            self.cloned += 1
+            self._report("cloned", instance=instance_name)
+
+    def instance_inserted(self, instance_name: str, new_instance_name: str) -> None:
+        with self._lock:
+            self.inserted += 1
+            self._report(
+                "inserted", instance=instance_name, new_instance=new_instance_name
+            )
+
+    def finished(self, error: Exception = None) -> None:
+        with self._lock:
+            if error:
+                self._report("failed", error=str(error))
+            else:
+                self._report("finished")
+
+            if self._events:
+                self._events.close()
+                self._events = None
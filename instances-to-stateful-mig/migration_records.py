@@ -0,0 +1,202 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import threading
+import typing
+
+import google.cloud.compute_v1 as compute_v1
+
+# The records below keep only the fields the migrator uses, so a run over
+# thousands of instances doesn't hold the full API responses in memory.
+
+
+class SourceDisk:
+    __slots__ = ("device_name", "source", "boot", "auto_delete")
+
+    def __init__(
+        self, device_name: str, source: str, boot: bool, auto_delete: bool
+    ) -> None:
+        self.device_name = device_name
+        self.source = source
+        self.boot = boot
+        self.auto_delete = auto_delete
+
+    @classmethod
+    def from_attached_disk(cls, disk: compute_v1.AttachedDisk) -> "SourceDisk":
+        return cls(disk.device_name, disk.source, disk.boot, disk.auto_delete)
+
+
+class SourceInstance:
+    __slots__ = ("name", "status", "self_link", "disks", "metadata")
+
+    def __init__(
+        self,
+        name: str,
+        status: str,
+        self_link: str,
+        disks: typing.Tuple[SourceDisk, ...],
+        metadata: typing.Tuple[typing.Tuple[str, str], ...],
+    ) -> None:
+        self.name = name
+        self.status = status
+        self.self_link = self_link
+        self.disks = disks
+        self.metadata = metadata
+
+    @classmethod
+    def from_instance(cls, instance: compute_v1.Instance) -> "SourceInstance":
+        return cls(
+            instance.name,
+            instance.status,
+            instance.self_link,
+            tuple(SourceDisk.from_attached_disk(disk) for disk in instance.disks),
+            tuple((item.key, item.value) for item in instance.metadata.items),
+        )
+
+    @property
+    def data_disks(self) -> typing.Tuple[SourceDisk, ...]:
+        return tuple(disk for disk in self.disks if not disk.boot)
+
+
+class DiskClone:
+    __slots__ = (
+        "instance_name",
+        "device_name",
+        "name",
+        "link",
+        "source_disk",
+        "zone",
+        "region",
+        "replica_zones",
+        "size_gb",
+        "disk_type",
+        "target_size_gb",
+        "target_disk_type",
+        "provisioned_iops",
+        "estimated_seconds",
+        "predicted_finish",
+    )
+
+    def __init__(self, instance_name: str, device_name: str, name: str) -> None:
+        self.instance_name = instance_name
+        self.device_name = device_name
+        self.name = name
+        self.link = None
+        self.source_disk = None
+        self.zone = None
+        self.region = None
+        self.replica_zones = ()
+        self.size_gb = 0
+        self.disk_type = None
+        self.target_size_gb = 0
+        self.target_disk_type = None
+        self.provisioned_iops = None
+        self.estimated_seconds = 0.0
+        self.predicted_finish = 0.0
+
+
+class DiskRule:
+    # Target settings of the disks cloned from data disks with the given device
+    # name ("*" matches every device name without its own rule)
+    OPTIONS = {
+        "type": ("disk_type", str),
+        "size_gb": ("size_gb", int),
+        "provisioned_iops": ("provisioned_iops", int),
+    }
+
+    __slots__ = ("device_name", "disk_type", "size_gb", "provisioned_iops")
+
+    def __init__(self, device_name: str) -> None:
+        self.device_name = device_name
+        self.disk_type = None
+        self.size_gb = None
+        self.provisioned_iops = None
+
+    @classmethod
+    def parse(cls, value: str) -> "DiskRule":
+        # Format: DEVICE_NAME:type=pd-ssd,size_gb=200,provisioned_iops=10000
+        device_name, _, options = value.partition(":")
+
+        if not device_name or not options:
+            raise ValueError(
+                f"expected DEVICE_NAME:OPTION=VALUE[,OPTION=VALUE...], got {value!r}"
+            )
+
+        rule = cls(device_name)
+
+        for option in options.split(","):
+            key, _, option_value = option.partition("=")
+
+            if key not in cls.OPTIONS or not option_value:
+                raise ValueError(
+                    f"invalid option {option!r}, expected one of: {', '.join(cls.OPTIONS)}"
+                )
+
+            attribute, convert = cls.OPTIONS[key]
+            setattr(rule, attribute, convert(option_value))
+
+        return rule
+
+
+class DecommissionResult:
+    __slots__ = ("instance_name", "deleted_disks", "snapshots", "reclaimed_gb", "error")
+
+    def __init__(self, instance_name: str) -> None:
+        self.instance_name = instance_name
+        self.deleted_disks = []
+        self.snapshots = []
+        self.reclaimed_gb = 0
+        self.error = None
+
+
+class Artifact:
+    __slots__ = ("kind", "name")
+
+    def __init__(self, kind: str, name: str) -> None:
+        self.kind = kind
+        self.name = name
+
+
+class ArtifactRegistry:
+    # Resources are deleted in the order of their priority, so instances go
+    # before their disks, the MIG goes before the template it uses, and disks
+    # go before the image
+    PRIORITIES = {
+        "mig_instance": 0,
+        "mig": 1,
+        "instance_template": 2,
+        "disk": 3,
+        "image": 4,
+    }
+
+    __slots__ = ("_by_kind", "_lock")
+
+    def __init__(self) -> None:
+        self._by_kind = collections.OrderedDict(
+            (kind, []) for kind in sorted(self.PRIORITIES, key=self.PRIORITIES.get)
+        )
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, name: str) -> Artifact:
+        artifact = Artifact(kind, name)
+
+        with self._lock:
+            self._by_kind[kind].append(artifact)
+
+        return artifact
+
+    def in_cleanup_order(self) -> typing.Iterator[Artifact]:
+        # Kinds are stored in the order of their priority, so nothing is re-sorted
+        for artifacts in self._by_kind.values():
+            yield from artifacts
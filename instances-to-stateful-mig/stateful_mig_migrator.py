@@ -12,14 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import collections
+import concurrent.futures
+import hashlib
+import math
+import random
 import re
+import threading
 import time
 import typing
 import uuid
 
+import google.api_core.exceptions
 import google.auth
 import google.cloud.compute_v1 as compute_v1
 
+import clone_scheduler
+from concurrency_controller import (
+    AdaptiveConcurrencyLimiter,
+    RateLimiter,
+    run_with_limiter,
+)
+from migration_progress import locked_print, ProgressReporter
+from migration_records import (
+    ArtifactRegistry,
+    DecommissionResult,
+    DiskClone,
+    SourceDisk,
+    SourceInstance,
+)
+
 
 instance_client = compute_v1.InstancesClient()
 zone_operations_client = compute_v1.ZoneOperationsClient()
@@ -31,6 +53,48 @@ instance_templates_client = compute_v1.InstanceTemplatesClient()
 instance_group_managers_client = compute_v1.InstanceGroupManagersClient()
 region_operations_client = compute_v1.RegionOperationsClient()
 region_instance_group_managers_client = compute_v1.RegionInstanceGroupManagersClient()
+regions_client = compute_v1.RegionsClient()
+disk_types_client = compute_v1.DiskTypesClient()
+region_disk_types_client = compute_v1.RegionDiskTypesClient()
+
+# Errors after which a mutating call is safe to repeat with the same request ID
+TRANSIENT_ERRORS = (
+    google.api_core.exceptions.InternalServerError,
+    google.api_core.exceptions.ServiceUnavailable,
+    google.api_core.exceptions.GatewayTimeout,
+    google.api_core.exceptions.TooManyRequests,
+    ConnectionError,
+)
+# Error codes of a finished operation after which the operation is safe to
+# start again. A failed operation can only be started again with a new request
+# ID, because a resent request ID returns the same failed operation.
+TRANSIENT_OPERATION_ERRORS = {
+    "INTERNAL_ERROR",
+    "RATE_LIMIT_EXCEEDED",
+    "RESOURCE_NOT_READY",
+    "RESOURCE_OPERATION_RATE_EXCEEDED",
+}
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+# Number of threads used for read-only API calls while planning the migration
+READ_WORKERS = 16
+# Quota metrics that the disks of every type count against
+DISK_QUOTA_METRICS = {
+    "pd-standard": "DISKS_TOTAL_GB",
+    "pd-balanced": "SSD_TOTAL_GB",
+    "pd-ssd": "SSD_TOTAL_GB",
+    "pd-extreme": "SSD_TOTAL_GB",
+}
+# Disk types that regional disks can't have
+ZONAL_DISK_TYPES = {"pd-extreme"}
+# Rough duration of stopping an instance and of adding an instance to the MIG,
+# used to weight the steps of the progress against the predicted clone time
+STOP_SECONDS = 30
+INSERT_SECONDS = 60
+# How long the verification waits for a new instance that is still starting up
+VERIFY_STATUS_TIMEOUT = 300
+# Names of Compute Engine resources can't be longer than this
+MAX_RESOURCE_NAME_LENGTH = 63
 
 
 class StatefulMIGMigrator:
@@ -40,6 +104,15 @@ class StatefulMIGMigrator:
         self.source_instance_zone = args.source_instance_zone
         self.mig_name = args.mig_name
         self.image_for_boot_disk = args.image_for_boot_disk
+        self.max_retries = args.max_retries
+        self.stop_workers = args.stop_workers
+        self.clone_workers = args.clone_workers
+        self.add_workers = args.add_workers
+        self.progress_fd = args.progress_fd
+        self.verify_workers = args.verify_workers
+        self.stateful_policy = args.stateful_policy
+        self.append = args.append
+        self.disk_rules = {rule.device_name: rule for rule in args.disk_rules}
 
         self.base_instance_name = (
             args.base_instance_name
@@ -56,17 +129,40 @@ class StatefulMIGMigrator:
         else:
             self.zone = self.source_instance_zone
 
-    def _get_instance(self, instance_name, instance_zone) -> None:
-        return instance_client.get(
-            project=self.project, zone=instance_zone, instance=instance_name,
+    def _get_instance(self, instance_name, instance_zone) -> SourceInstance:
+        return SourceInstance.from_instance(
+            instance_client.get(
+                project=self.project, zone=instance_zone, instance=instance_name,
+            )
         )
 
-    def _stop_instance(self, instance_name: str, instance_zone: str) -> None:
-        operation = instance_client.stop_unary(
-            project=self.project, zone=instance_zone, instance=instance_name,
+    def _stop_instance(
+        self,
+        instance_name: str,
+        instance_zone: str,
+        limiter: AdaptiveConcurrencyLimiter = None,
+    ) -> None:
+        self._run_operation(
+            f"stop instance {instance_name}",
+            lambda request_id: instance_client.stop_unary(
+                request=compute_v1.StopInstanceRequest(
+                    project=self.project,
+                    zone=instance_zone,
+                    instance=instance_name,
+                    request_id=request_id,
+                )
+            ),
+            zone=instance_zone,
+            limiter=limiter,
         )
 
-        self._wait_for_operation(operation, instance_zone)
+    def _build_resource_name(self, prefix: str, *parts: str) -> str:
+        # The suffix is derived from the MIG name and the source resource, so
+        # a retried or repeated call always targets the same resource name
+        digest = hashlib.sha1(
+            "/".join((self.project, self.mig_name, prefix) + parts).encode()
+        ).hexdigest()
+        return f"{prefix}-{digest[:6]}"
 
     def _build_template_link(self, template_name: str) -> str:
         return f"projects/{self.project}/global/instanceTemplates/{template_name}"
@@ -80,6 +176,12 @@ class StatefulMIGMigrator:
     def _build_region_disk_link(self, disk_name: str, disk_region: str) -> str:
         return f"projects/{self.project}/regions/{disk_region}/disks/{disk_name}"
 
+    def _build_disk_type_link(self, disk_type: str, disk_zone: str) -> str:
+        return f"projects/{self.project}/zones/{disk_zone}/diskTypes/{disk_type}"
+
+    def _build_region_disk_type_link(self, disk_type: str, disk_region: str) -> str:
+        return f"projects/{self.project}/regions/{disk_region}/diskTypes/{disk_type}"
+
     def _build_zone_link(self, zone: str) -> str:
         return f"https://www.googleapis.com/compute/v1/projects/{self.project}/zones/{zone}"
 
@@ -89,132 +191,638 @@ class StatefulMIGMigrator:
     def _parse_disk_region_from_source(self, source: str) -> str:
         return re.search("/regions/(.*?)/", source).group(1)
 
-    def _create_image_for_disk(self, disk: compute_v1.AttachedDisk) -> str:
-        image_name = f"{disk.device_name}-image-{uuid.uuid4().hex[:6]}"
+    def _parse_instance_zone_from_link(self, link: str) -> str:
+        return re.search("/zones/(.*?)/", link).group(1)
 
-        operation = images_client.insert_unary(
-            project=self.project,
-            image_resource={"name": image_name, "source_disk": disk.source},
-        )
+    def _create_image_for_disk(self, disk: SourceDisk) -> str:
+        image_name = self._build_resource_name(f"{disk.device_name}-image")
 
-        self._wait_for_operation(operation)
+        self._run_operation(
+            f"create image {image_name}",
+            lambda request_id: images_client.insert_unary(
+                request=compute_v1.InsertImageRequest(
+                    project=self.project,
+                    image_resource={"name": image_name, "source_disk": disk.source},
+                    request_id=request_id,
+                )
+            ),
+        )
 
         return image_name
 
+    def _stop_source_instance(
+        self, instance: SourceInstance, limiter: AdaptiveConcurrencyLimiter
+    ) -> None:
+        is_running = instance.status != compute_v1.Instance.Status.TERMINATED.name
+
+        if is_running:
+            locked_print(f"Instance {instance.name} is not stopped. Stopping ...")
+
+            self._stop_instance(instance.name, self.source_instance_zone, limiter)
+
+            locked_print(f"Instance {instance.name} stopped", "==========")
+
+        self.progress.instance_stopped(instance.name, is_running)
+
+    def _build_stateful_policy(self) -> dict:
+        # Declare every data disk of the base instance as stateful for the whole
+        # MIG, so the disks stay preserved for every member, whatever happens to
+        # its per-instance config. The per-instance configs still point every
+        # device name to the cloned disk of the instance.
+        return {
+            "preserved_state": {
+                "disks": {
+                    disk.device_name: {"auto_delete": "NEVER"}
+                    for disk in self.base_instance.data_disks
+                }
+            }
+        }
+
+    def _check_stateful_policy(
+        self, source_instances: typing.Dict[str, SourceInstance]
+    ) -> None:
+        # A data disk under a device name that the stateful policy doesn't declare
+        # would only be preserved by its per-instance config
+        if self.append:
+            declared_device_names = set(
+                self._get_mig().stateful_policy.preserved_state.disks
+            )
+        else:
+            declared_device_names = set(
+                self._build_stateful_policy()["preserved_state"]["disks"]
+            )
+
+        problems = []
+
+        for instance in source_instances.values():
+            missing_device_names = [
+                disk.device_name
+                for disk in instance.data_disks
+                if disk.device_name not in declared_device_names
+            ]
+
+            if missing_device_names:
+                problems.append(
+                    f"{instance.name} ({', '.join(missing_device_names)})"
+                )
+
+        if problems:
+            raise RuntimeError(
+                "Data disks of these instances aren't declared in the stateful policy "
+                f"of {self.mig_name} MIG: {'; '.join(problems)}. "
+                "All source instances must use the device names of the data disks "
+                + ("that the MIG declares" if self.append else "of the base instance")
+            )
+
     def _create_empty_mig(self, template_name: str) -> None:
+        stateful_policy = (
+            self._build_stateful_policy() if self.stateful_policy else None
+        )
+
         if self.zone:
-            operation = instance_group_managers_client.insert_unary(
-                project=self.project,
+            self._run_operation(
+                f"create MIG {self.mig_name}",
+                lambda request_id: instance_group_managers_client.insert_unary(
+                    request=compute_v1.InsertInstanceGroupManagerRequest(
+                        project=self.project,
+                        zone=self.zone,
+                        instance_group_manager_resource={
+                            "target_size": 0,
+                            "name": self.mig_name,
+                            "instance_template": self._build_template_link(
+                                template_name
+                            ),
+                            "stateful_policy": stateful_policy,
+                        },
+                        request_id=request_id,
+                    )
+                ),
                 zone=self.zone,
-                instance_group_manager_resource={
-                    "target_size": 0,
-                    "name": self.mig_name,
-                    "instance_template": self._build_template_link(template_name),
-                },
             )
 
-            self._wait_for_operation(operation, self.zone)
-
         if self.region:
-            operation = region_instance_group_managers_client.insert_unary(
-                project=self.project,
+            self._run_operation(
+                f"create MIG {self.mig_name}",
+                lambda request_id: region_instance_group_managers_client.insert_unary(
+                    request=compute_v1.InsertRegionInstanceGroupManagerRequest(
+                        project=self.project,
+                        region=self.region,
+                        instance_group_manager_resource={
+                            "target_size": 0,
+                            "name": self.mig_name,
+                            "instance_template": self._build_template_link(
+                                template_name
+                            ),
+                            # Set the instance redistribution type to NONE so that the MIG does not automatically redistribute instances across zones.
+                            # (https://cloud.google.com/compute/docs/instance-groups/distributing-instances-with-regional-instance-groups#disabling_and_reenabling_proactive_instance_redistribution)
+                            "update_policy": {"instance_redistribution_type": "NONE"},
+                            "stateful_policy": stateful_policy,
+                            # Use all zones of the region, so instances added later
+                            # can be placed wherever their disks are replicated
+                            "distribution_policy": {
+                                "zones": [
+                                    {"zone": self._build_zone_link(zone)}
+                                    for zone in self.region_zones
+                                ]
+                            },
+                        },
+                        request_id=request_id,
+                    )
+                ),
                 region=self.region,
-                instance_group_manager_resource={
-                    "target_size": 0,
-                    "name": self.mig_name,
-                    "instance_template": self._build_template_link(template_name),
-                    # Set the instance redistribution type to NONE so that the MIG does not automatically redistribute instances across zones.
-                    # (https://cloud.google.com/compute/docs/instance-groups/distributing-instances-with-regional-instance-groups#disabling_and_reenabling_proactive_instance_redistribution)
-                    "update_policy": {"instance_redistribution_type": "NONE"},
-                },
             )
 
-            self._wait_for_operation(operation, zone=None, region=self.region)
-
     def _create_instance_template(self, disk_configs: typing.List[dict]) -> str:
-        template_name = f"{self.base_instance_name}-template-{uuid.uuid4().hex[:6]}"
-
-        operation = instance_templates_client.insert_unary(
-            project=self.project,
-            instance_template_resource={
-                "name": template_name,
-                "source_instance": self.base_instance.self_link,
-                "source_instance_params": {"disk_configs": disk_configs},
-            },
+        template_name = self._build_resource_name(
+            f"{self.base_instance_name}-template"
         )
 
-        self._wait_for_operation(operation)
+        self._run_operation(
+            f"create instance template {template_name}",
+            lambda request_id: instance_templates_client.insert_unary(
+                request=compute_v1.InsertInstanceTemplateRequest(
+                    project=self.project,
+                    instance_template_resource={
+                        "name": template_name,
+                        "source_instance": self.base_instance.self_link,
+                        "source_instance_params": {"disk_configs": disk_configs},
+                    },
+                    request_id=request_id,
+                )
+            ),
+        )
 
         return template_name
 
+    def _build_preserved_metadata(
+        self, instance: SourceInstance
+    ) -> typing.Dict[str, str]:
+        # New instances get the template metadata, which is copied from the base
+        # instance, so only the keys that differ from it are preserved per instance
+        preserved_metadata = {
+            key: value
+            for key, value in instance.metadata
+            if self.template_metadata.get(key) != value
+        }
+
+        instance_keys = {key for key, _ in instance.metadata}
+        missing_keys = [key for key in self.template_metadata if key not in instance_keys]
+
+        if missing_keys:
+            locked_print(
+                f"Warning: instance {instance.name} doesn't have the template metadata keys "
+                f"{', '.join(missing_keys)}, the new instance will have them"
+            )
+
+        return preserved_metadata
+
     def _add_instance_to_mig(
-        self, instance_name: str, attached_disks, metadata
+        self,
+        instance_name: str,
+        attached_disks,
+        metadata,
+        limiter: AdaptiveConcurrencyLimiter = None,
     ) -> None:
         if self.zone:
-            operation = instance_group_managers_client.create_instances_unary(
-                project=self.project,
+            self._run_operation(
+                f"add instance {instance_name} to MIG {self.mig_name}",
+                lambda request_id: instance_group_managers_client.create_instances_unary(
+                    request=compute_v1.CreateInstancesInstanceGroupManagerRequest(
+                        project=self.project,
+                        zone=self.zone,
+                        instance_group_manager=self.mig_name,
+                        instance_group_managers_create_instances_request_resource=compute_v1.InstanceGroupManagersCreateInstancesRequest(
+                            instances=[
+                                compute_v1.PerInstanceConfig(
+                                    name=instance_name,
+                                    preserved_state=compute_v1.PreservedState(
+                                        disks=attached_disks, metadata=metadata,
+                                    ),
+                                )
+                            ]
+                        ),
+                        request_id=request_id,
+                    )
+                ),
                 zone=self.zone,
-                instance_group_manager=self.mig_name,
-                instance_group_managers_create_instances_request_resource=compute_v1.InstanceGroupManagersCreateInstancesRequest(
-                    instances=[
-                        compute_v1.PerInstanceConfig(
-                            name=instance_name,
-                            preserved_state=compute_v1.PreservedState(
-                                disks=attached_disks, metadata=metadata,
-                            ),
-                        )
-                    ]
+                limiter=limiter,
+            )
+
+        if self.region:
+            self._run_operation(
+                f"add instance {instance_name} to MIG {self.mig_name}",
+                lambda request_id: region_instance_group_managers_client.create_instances_unary(
+                    request=compute_v1.CreateInstancesRegionInstanceGroupManagerRequest(
+                        project=self.project,
+                        region=self.region,
+                        instance_group_manager=self.mig_name,
+                        region_instance_group_managers_create_instances_request_resource=compute_v1.RegionInstanceGroupManagersCreateInstancesRequest(
+                            instances=[
+                                compute_v1.PerInstanceConfig(
+                                    name=instance_name,
+                                    preserved_state=compute_v1.PreservedState(
+                                        disks=attached_disks, metadata=metadata,
+                                    ),
+                                )
+                            ]
+                        ),
+                        request_id=request_id,
+                    )
                 ),
+                region=self.region,
+                limiter=limiter,
             )
 
-            self._wait_for_operation(operation, self.zone)
+        # Waiting while the instance is being created
+        while any(
+            instance.instance.endswith(f"/instances/{instance_name}")
+            and instance.current_action
+            == compute_v1.ManagedInstance.CurrentAction.CREATING.name
+            for instance in self._list_managed_instances()
+        ):
+            time.sleep(3)
+
+    def _add_source_instance_to_mig(
+        self,
+        instance: SourceInstance,
+        new_disk_links: typing.Dict[str, str],
+        limiter: AdaptiveConcurrencyLimiter,
+    ) -> None:
+        metadata = self._build_preserved_metadata(instance)
 
-            # Waiting while all instances in the MIG will be created
-            while not all(
-                instance.current_action
-                != compute_v1.ManagedInstance.CurrentAction.CREATING.name
-                for instance in instance_group_managers_client.list_managed_instances(
-                    project=self.project,
-                    zone=self.zone,
-                    instance_group_manager=self.mig_name,
-                )
-            ):
-                time.sleep(3)
+        new_instance_name = self._build_resource_name(instance.name)
+
+        locked_print(
+            f"Adding instance {new_instance_name} to {self.mig_name} MIG", "==========\n"
+        )
+
+        new_disks_config = {
+            device_name: compute_v1.PreservedStatePreservedDisk(source=link)
+            for device_name, link in new_disk_links.items()
+        }
+
+        self._add_instance_to_mig(new_instance_name, new_disks_config, metadata, limiter)
+
+        if self.append:
+            self.created_artifacts.add("mig_instance", new_instance_name)
+
+        self.progress.instance_inserted(instance.name, new_instance_name)
+
+    def _plan_disk_clone(self, instance_name: str, disk: SourceDisk) -> DiskClone:
+        source_disk_name = disk.source.split("/")[-1]
+
+        clone_job = DiskClone(
+            instance_name,
+            disk.device_name,
+            self._build_resource_name(disk.device_name, instance_name),
+        )
+
+        if self.zone:
+            disk_zone = self._parse_disk_zone_from_source(disk.source)
+
+            disk_object = disks_client.get(
+                project=self.project, zone=disk_zone, disk=source_disk_name,
+            )
+
+            clone_job.zone = disk_zone
+            clone_job.source_disk = self._build_disk_link(
+                source_disk_name, disk_zone
+            )
+            clone_job.link = self._build_disk_link(clone_job.name, disk_zone)
 
         if self.region:
-            operation = region_instance_group_managers_client.create_instances_unary(
-                project=self.project,
-                region=self.region,
-                instance_group_manager=self.mig_name,
-                region_instance_group_managers_create_instances_request_resource=compute_v1.RegionInstanceGroupManagersCreateInstancesRequest(
-                    instances=[
-                        compute_v1.PerInstanceConfig(
-                            name=instance_name,
-                            preserved_state=compute_v1.PreservedState(
-                                disks=attached_disks, metadata=metadata,
+            disk_region = self._parse_disk_region_from_source(disk.source)
+
+            disk_object = region_disks_client.get(
+                project=self.project, region=disk_region, disk=source_disk_name,
+            )
+
+            clone_job.region = disk_region
+            clone_job.replica_zones = tuple(disk_object.replica_zones)
+            clone_job.source_disk = self._build_region_disk_link(
+                source_disk_name, disk_region
+            )
+            clone_job.link = self._build_region_disk_link(
+                clone_job.name, disk_region
+            )
+
+        clone_job.size_gb = disk_object.size_gb
+        clone_job.disk_type = disk_object.type_.split("/")[-1]
+        clone_job.estimated_seconds = clone_scheduler.estimate_clone_seconds(
+            clone_job.size_gb, clone_job.disk_type
+        )
+
+        rule = self.disk_rules.get(disk.device_name, self.disk_rules.get("*"))
+
+        clone_job.target_size_gb = clone_job.size_gb
+        clone_job.target_disk_type = clone_job.disk_type
+
+        if rule:
+            if rule.size_gb:
+                if rule.size_gb < clone_job.size_gb:
+                    raise ValueError(
+                        f"Disk rule for {disk.device_name} sets size_gb to {rule.size_gb}, "
+                        f"but source disk {source_disk_name} has {clone_job.size_gb} GB"
+                    )
+
+                clone_job.target_size_gb = rule.size_gb
+
+            if rule.disk_type:
+                clone_job.target_disk_type = rule.disk_type
+
+            if rule.provisioned_iops and clone_job.target_disk_type != "pd-extreme":
+                raise ValueError(
+                    f"Disk rule for {disk.device_name} sets provisioned_iops, but the "
+                    f"cloned disk type is {clone_job.target_disk_type}, not pd-extreme"
+                )
+
+            clone_job.provisioned_iops = rule.provisioned_iops
+
+        return clone_job
+
+    def _check_disk_types(self, clone_jobs: typing.List[DiskClone]) -> None:
+        # A mistyped disk type would only fail the clones after the source
+        # instances are stopped, so the types changed by disk rules are looked
+        # up once for every zone or region
+        disk_types = sorted(
+            {
+                (clone_job.target_disk_type, clone_job.zone or clone_job.region)
+                for clone_job in clone_jobs
+                if clone_job.target_disk_type != clone_job.disk_type
+            }
+        )
+
+        for disk_type, location in disk_types:
+            if self.region and disk_type in ZONAL_DISK_TYPES:
+                raise ValueError(
+                    f"Disk type {disk_type} can't be used for regional disks"
+                )
+
+            try:
+                if self.zone:
+                    disk_types_client.get(
+                        project=self.project, zone=location, disk_type=disk_type
+                    )
+                else:
+                    region_disk_types_client.get(
+                        project=self.project, region=location, disk_type=disk_type
+                    )
+            except google.api_core.exceptions.NotFound:
+                raise ValueError(
+                    f"Disk type {disk_type} isn't available in {location}"
+                ) from None
+
+    def _check_disk_quota(self, clone_jobs: typing.List[DiskClone]) -> None:
+        required_gb = collections.Counter()
+
+        for clone_job in clone_jobs:
+            disk_region = clone_job.region or "-".join(clone_job.zone.split("-")[:-1])
+            metric = DISK_QUOTA_METRICS.get(clone_job.target_disk_type)
+
+            if metric:
+                required_gb[(disk_region, metric)] += clone_job.target_size_gb
+            else:
+                print(
+                    f"Warning: quota of disk type {clone_job.target_disk_type} "
+                    f"isn't checked for disk {clone_job.name}"
+                )
+
+        if not required_gb:
+            return
+
+        regions = {}
+
+        for (disk_region, metric), gb in sorted(required_gb.items()):
+            if disk_region not in regions:
+                regions[disk_region] = regions_client.get(
+                    project=self.project, region=disk_region
+                )
+
+            quotas = {quota.metric: quota for quota in regions[disk_region].quotas}
+
+            if metric not in quotas:
+                raise RuntimeError(
+                    f"Region {disk_region} doesn't report the {metric} quota, "
+                    "so the disk quota can't be checked"
+                )
+
+            available_gb = int(quotas[metric].limit - quotas[metric].usage)
+            print(
+                f"Quota {metric} in {disk_region}: {gb} GB required, {available_gb} GB available"
+            )
+
+            if gb > available_gb:
+                raise RuntimeError(
+                    f"Not enough {metric} quota in {disk_region} to clone the disks"
+                )
+
+        print("==========")
+
+    def _check_instance_zones(
+        self, instance_names: typing.List[str], clone_jobs: typing.List[DiskClone]
+    ) -> None:
+        # A member of a regional MIG can only attach its regional disks in one of
+        # their replica zones. The MIG picks the zone of every member, so the
+        # script can only check that such a zone exists for every instance.
+        region = regions_client.get(project=self.project, region=self.region)
+        self.region_zones = sorted(zone.split("/")[-1] for zone in region.zones)
+        mig_zones = set(self.region_zones)
+
+        if self.append:
+            # The MIG can only create instances in the zones of its distribution policy
+            mig_zones = {
+                zone.zone.split("/")[-1]
+                for zone in self._get_mig().distribution_policy.zones
+            } or mig_zones
+
+        allowed_zones = {
+            instance_name: set(mig_zones) for instance_name in instance_names
+        }
+
+        for clone_job in clone_jobs:
+            allowed_zones[clone_job.instance_name] &= {
+                zone.split("/")[-1] for zone in clone_job.replica_zones
+            }
+
+        for instance_name, zones in allowed_zones.items():
+            if not zones:
+                raise RuntimeError(
+                    f"Data disks of instance {instance_name} aren't all replicated in "
+                    f"one of the zones of {self.mig_name} MIG: {', '.join(sorted(mig_zones))}"
+                )
+
+    def _print_zone_counts(self) -> None:
+        zone_counts = collections.Counter(
+            self._parse_instance_zone_from_link(managed_instance.instance)
+            for managed_instance in self._list_managed_instances()
+            if managed_instance.instance
+        )
+
+        print(
+            f"Instances of {self.mig_name} MIG per zone: "
+            + ", ".join(
+                f"{zone}: {count}" for zone, count in sorted(zone_counts.items())
+            )
+        )
+        print("==========")
+
+    def _clone_disk(
+        self, clone_job: DiskClone, limiter: AdaptiveConcurrencyLimiter = None
+    ) -> None:
+        disk_resource = {"source_disk": clone_job.source_disk, "name": clone_job.name}
+        description = f"{clone_job.size_gb} GB, {clone_job.disk_type}"
+
+        if (clone_job.target_size_gb, clone_job.target_disk_type) != (
+            clone_job.size_gb,
+            clone_job.disk_type,
+        ):
+            disk_resource["size_gb"] = clone_job.target_size_gb
+            description += (
+                f" -> {clone_job.target_size_gb} GB, {clone_job.target_disk_type}"
+            )
+
+        if clone_job.target_disk_type != clone_job.disk_type:
+            disk_resource["type_"] = (
+                self._build_disk_type_link(clone_job.target_disk_type, clone_job.zone)
+                if self.zone
+                else self._build_region_disk_type_link(
+                    clone_job.target_disk_type, clone_job.region
+                )
+            )
+
+        if clone_job.provisioned_iops:
+            disk_resource["provisioned_iops"] = clone_job.provisioned_iops
+            description += f", {clone_job.provisioned_iops} IOPS"
+
+        locked_print(
+            f"Creating disk {clone_job.name} from disk {clone_job.device_name} ({description})"
+        )
+
+        try:
+            if self.zone:
+                self._run_operation(
+                    f"create disk {clone_job.name}",
+                    lambda request_id: disks_client.insert_unary(
+                        request=compute_v1.InsertDiskRequest(
+                            project=self.project,
+                            zone=clone_job.zone,
+                            disk_resource=disk_resource,
+                            request_id=request_id,
+                        )
+                    ),
+                    zone=clone_job.zone,
+                    limiter=limiter,
+                    operation_cost=clone_job.estimated_seconds,
+                )
+
+            if self.region:
+                self._run_operation(
+                    f"create disk {clone_job.name}",
+                    lambda request_id: region_disks_client.insert_unary(
+                        request=compute_v1.InsertRegionDiskRequest(
+                            project=self.project,
+                            region=clone_job.region,
+                            disk_resource=dict(
+                                disk_resource,
+                                replica_zones=list(clone_job.replica_zones),
                             ),
+                            request_id=request_id,
                         )
-                    ]
-                ),
+                    ),
+                    region=clone_job.region,
+                    limiter=limiter,
+                    operation_cost=clone_job.estimated_seconds,
+                )
+        except google.api_core.exceptions.Conflict:
+            # A run that failed after cloning leaves the clone behind under the
+            # same name, so it is reused if it was cloned from the same disk
+            existing_disk = self._get_disk(clone_job.link)
+
+            if not existing_disk.source_disk or self._parse_disk_path(
+                existing_disk.source_disk
+            ) != self._parse_disk_path(clone_job.source_disk):
+                raise RuntimeError(
+                    f"Disk {clone_job.name} already exists, but it wasn't cloned "
+                    f"from disk {clone_job.source_disk}"
+                )
+
+            locked_print(f"Disk {clone_job.name} already exists, reusing it")
+
+        self.created_artifacts.add("disk", clone_job.name)
+
+    def _clone_disks(
+        self, clone_jobs: typing.List[DiskClone]
+    ) -> typing.Dict[str, typing.Dict[str, str]]:
+        clone_limiter = AdaptiveConcurrencyLimiter("disk clones", self.clone_workers)
+
+        # The prediction uses the starting limit, which only grows while the
+        # clones run at their usual speed
+        ordered_jobs, predicted_duration = clone_scheduler.plan_longest_job_first(
+            clone_jobs, int(clone_limiter.limit)
+        )
+
+        print(
+            f"Cloning {len(ordered_jobs)} disks with {int(clone_limiter.limit)} to "
+            f"{self.clone_workers} workers, longest clones first. "
+            f"Predicted completion in {int(predicted_duration)} seconds"
+        )
+        print("==========")
+
+        clone_start_time = time.time()
+        clone_lock = threading.Lock()
+        new_disks_configs = {}
+        remaining_disks = collections.Counter(
+            clone_job.instance_name for clone_job in ordered_jobs
+        )
+
+        def clone_disk(clone_job: DiskClone) -> None:
+            self._clone_disk(clone_job, clone_limiter)
+
+            locked_print(
+                f"Disk {clone_job.name} created after "
+                f"{int(time.time() - clone_start_time)} seconds "
+                f"(predicted {int(clone_job.predicted_finish)} seconds)"
+            )
+            self.progress.disk_cloned(
+                clone_job.instance_name, clone_job.name, clone_job.size_gb
             )
 
-            self._wait_for_operation(operation, zone=None, region=self.region)
+            with clone_lock:
+                new_disks_configs.setdefault(clone_job.instance_name, {})[
+                    clone_job.device_name
+                ] = clone_job.link
+                remaining_disks[clone_job.instance_name] -= 1
+                instance_cloned = not remaining_disks[clone_job.instance_name]
 
-            # Waiting while all instances in the MIG will be created
-            while not all(
-                instance.current_action
-                != compute_v1.ManagedInstance.CurrentAction.CREATING.name
-                for instance in region_instance_group_managers_client.list_managed_instances(
-                    project=self.project,
-                    region=self.region,
-                    instance_group_manager=self.mig_name,
-                )
-            ):
-                time.sleep(3)
+            if instance_cloned:
+                self.progress.instance_cloned(clone_job.instance_name)
+
+        self._run_with_limiter(clone_limiter, clone_disk, ordered_jobs)
+
+        print(
+            f"All disks cloned in {int(time.time() - clone_start_time)} seconds "
+            f"(predicted {int(predicted_duration)} seconds)"
+        )
+        print("==========")
+
+        return new_disks_configs
+
+    def _run_with_limiter(
+        self,
+        limiter: AdaptiveConcurrencyLimiter,
+        function: typing.Callable[[typing.Any], typing.Any],
+        items: typing.Iterable[typing.Any],
+    ) -> typing.List[typing.Any]:
+        self.concurrency_limiters.append(limiter)
+
+        with concurrent.futures.ThreadPoolExecutor(limiter.max_limit) as executor:
+            futures = run_with_limiter(limiter, function, items, executor)
+
+            return [future.result() for future in futures]
 
     def _wait_for_operation(
         self, operation: compute_v1.Operation, zone: str = None, region: str = None
-    ) -> None:
+    ) -> compute_v1.Operation:
         while operation.status != compute_v1.Operation.Status.DONE:
             if zone:
                 operation = zone_operations_client.wait(
@@ -229,215 +837,947 @@ class StatefulMIGMigrator:
                     operation=operation.name, project=self.project,
                 )
 
-    def _print_cleanup_commands(self) -> None:
-        print("\nTo revert all changes, use this clean up commands:")
+        return operation
+
+    def _run_operation(
+        self,
+        description: str,
+        send_request: typing.Callable[[str], compute_v1.Operation],
+        zone: str = None,
+        region: str = None,
+        limiter: AdaptiveConcurrencyLimiter = None,
+        operation_cost: float = 1.0,
+        rate_limiter: RateLimiter = None,
+    ) -> None:
+        # The request ID stays the same when a request is resent after an API
+        # error, so the API ignores it if the previous one has already been accepted
+        request_id = str(uuid.uuid4())
+
+        for attempt in range(self.max_retries + 1):
+            if rate_limiter:
+                rate_limiter.acquire()
+
+            try:
+                operation_start_time = time.time()
+                operation = self._wait_for_operation(
+                    send_request(request_id), zone, region
+                )
+            except google.api_core.exceptions.Conflict:
+                # The resource was created by one of the previous attempts
+                if attempt == 0:
+                    raise
+                return
+            except TRANSIENT_ERRORS as err:
+                error = err
+            else:
+                if not operation.error.errors:
+                    if limiter:
+                        limiter.record_latency(
+                            time.time() - operation_start_time, operation_cost
+                        )
+                    return
+
+                error = RuntimeError(
+                    "; ".join(
+                        f"{operation_error.code}: {operation_error.message}"
+                        for operation_error in operation.error.errors
+                    )
+                )
 
-        self.created_artifacts.sort(key=lambda x: x["priority"])
+                if any(
+                    operation_error.code not in TRANSIENT_OPERATION_ERRORS
+                    for operation_error in operation.error.errors
+                ):
+                    raise RuntimeError(f"Failed to {description}: {error}")
 
-        for artifact in self.created_artifacts:
-            if artifact["key"] == "instance_template":
-                print(f"* gcloud compute instance-templates delete {artifact['name']}")
+                request_id = str(uuid.uuid4())
 
-            if artifact["key"] == "disk":
-                print(f"* gcloud compute disks delete {artifact['name']}")
+            if limiter:
+                limiter.record_error(error)
 
-            if artifact["key"] == "mig":
-                print(
-                    f"* gcloud compute instance-groups managed delete {artifact['name']}"
+            if attempt == self.max_retries:
+                raise error
+
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+            delay *= random.uniform(0.5, 1)
+            locked_print(
+                f"Failed to {description}: {error}. Retrying in {delay:.1f} seconds ..."
+            )
+            time.sleep(delay)
+
+    def _list_managed_instances(self) -> typing.List[compute_v1.ManagedInstance]:
+        if self.zone:
+            return list(
+                instance_group_managers_client.list_managed_instances(
+                    project=self.project,
+                    zone=self.zone,
+                    instance_group_manager=self.mig_name,
                 )
+            )
 
-            if artifact["key"] == "image":
-                print(f"* gcloud compute images delete {artifact['name']}")
-        print()
+        return list(
+            region_instance_group_managers_client.list_managed_instances(
+                project=self.project,
+                region=self.region,
+                instance_group_manager=self.mig_name,
+            )
+        )
 
-    def migrate(self) -> None:
-        self.created_artifacts = []
+    def _list_per_instance_configs(
+        self,
+    ) -> typing.List[compute_v1.PerInstanceConfig]:
+        if self.zone:
+            return list(
+                instance_group_managers_client.list_per_instance_configs(
+                    project=self.project,
+                    zone=self.zone,
+                    instance_group_manager=self.mig_name,
+                )
+            )
 
-        try:
-            script_start_time = time.time()
-            self.base_instance = self._get_instance(
-                self.base_instance_name, self.source_instance_zone
+        return list(
+            region_instance_group_managers_client.list_per_instance_configs(
+                project=self.project,
+                region=self.region,
+                instance_group_manager=self.mig_name,
             )
+        )
 
-            # Step 1. Stop all instances
+    def _parse_disk_path(self, link: str) -> str:
+        # "https://.../projects/p/zones/z/disks/d" -> "zones/z/disks/d"
+        return re.search("(zones|regions)/[^/]+/disks/[^/]+$", link).group(0)
 
-            for instance_name in self.source_instances:
-                instance = self._get_instance(instance_name, self.source_instance_zone)
+    def _get_disk(self, disk_link: str) -> compute_v1.Disk:
+        disk_name = disk_link.split("/")[-1]
 
-                if instance.status != compute_v1.Instance.Status.TERMINATED.name:
-                    print(f"Instance {instance.name} is not stopped. Stopping ...")
+        if "/regions/" in disk_link:
+            return region_disks_client.get(
+                project=self.project,
+                region=self._parse_disk_region_from_source(disk_link),
+                disk=disk_name,
+            )
 
-                    self._stop_instance(instance_name, self.source_instance_zone)
+        return disks_client.get(
+            project=self.project,
+            zone=self._parse_disk_zone_from_source(disk_link),
+            disk=disk_name,
+        )
 
-                    print(f"Instance {instance.name} stopped")
-                    print("==========")
+    def _get_source_disk_owners(self) -> typing.Dict[str, str]:
+        # Maps the disks of the source instances to the instance names. Source
+        # instances that have already been deleted are skipped.
+        def get_instance(instance_name: str) -> typing.Optional[SourceInstance]:
+            try:
+                return self._get_instance(instance_name, self.source_instance_zone)
+            except google.api_core.exceptions.NotFound:
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(READ_WORKERS) as executor:
+            instances = list(executor.map(get_instance, self.source_instances))
+
+        return {
+            self._parse_disk_path(disk.source): instance.name
+            for instance in instances
+            if instance
+            for disk in instance.disks
+        }
+
+    def _find_config_source(
+        self,
+        config: compute_v1.PerInstanceConfig,
+        new_instance_sources: typing.Dict[str, str],
+        get_source_disk_owners: typing.Callable[[], typing.Dict[str, str]],
+    ) -> typing.Optional[str]:
+        # Instances created by this version of the script are named after the
+        # hash of the source instance name
+        if config.name in new_instance_sources:
+            return new_instance_sources[config.name]
+
+        # Instances created by earlier versions of the script are named
+        # "{source instance}-{6 random hex digits}". Only the exact format is
+        # matched, so "web-2-1a2b3c" isn't taken for an instance of "web".
+        for instance_name in self.source_instances:
+            if re.fullmatch(re.escape(instance_name) + "-[0-9a-f]{6}", config.name):
+                return instance_name
+
+        # Instances created by hand are traced back through the disks they
+        # preserve, which were cloned from the disks of the source instance
+        for preserved_disk in config.preserved_state.disks.values():
+            disk_paths = [self._parse_disk_path(preserved_disk.source)]
+            source_disk = self._get_disk(preserved_disk.source).source_disk
+
+            if source_disk:
+                disk_paths.append(self._parse_disk_path(source_disk))
+
+            for disk_path in disk_paths:
+                instance_name = get_source_disk_owners().get(disk_path)
+
+                if instance_name:
+                    return instance_name
+
+        return None
+
+    def _map_configs_to_sources(
+        self,
+    ) -> typing.Tuple[
+        typing.Dict[str, compute_v1.PerInstanceConfig], typing.List[str]
+    ]:
+        # Returns the per-instance config of every source instance that is in
+        # the MIG, and the names of the configs that don't match any of them
+        new_instance_sources = {
+            self._build_resource_name(instance_name): instance_name
+            for instance_name in self.source_instances
+        }
+        source_disk_owners = []
+
+        def get_source_disk_owners() -> typing.Dict[str, str]:
+            # The source instances are only read if some config needs them
+            if not source_disk_owners:
+                source_disk_owners.append(self._get_source_disk_owners())
+            return source_disk_owners[0]
+
+        source_configs = {}
+        unknown_configs = []
+
+        for config in self._list_per_instance_configs():
+            instance_name = self._find_config_source(
+                config, new_instance_sources, get_source_disk_owners
+            )
 
-            # Step 2. Create an instance template from the base instance
+            if instance_name:
+                source_configs[instance_name] = config
+            else:
+                unknown_configs.append(config.name)
 
-            base_disk_configs = []
+        return source_configs, unknown_configs
 
-            for disk in self.base_instance.disks:
-                if disk.boot:
-                    if self.image_for_boot_disk:
-                        print(
-                            f"Creating disk image for boot image {disk.device_name} ..."
-                        )
-                        image_name = self._create_image_for_disk(disk)
-                        print(f"Disk image {image_name} created")
-                        print("==========")
+    def _find_unmigrated_instances(self) -> typing.List[str]:
+        source_configs, unknown_configs = self._map_configs_to_sources()
 
-                        self.created_artifacts.append(
-                            {"key": "image", "name": image_name, "priority": 4}
-                        )
+        if unknown_configs:
+            raise RuntimeError(
+                f"Instances {', '.join(unknown_configs)} of {self.mig_name} MIG can't be "
+                "mapped to any of the source instances. Pass all source instances "
+                "that were migrated to the MIG."
+            )
 
-                        base_disk_configs.append(
-                            {
-                                "device_name": disk.device_name,
-                                "custom_image": self._build_image_link(image_name),
-                                "instantiate_from": "CUSTOM_IMAGE",
-                            }
-                        )
+        instance_names = [
+            instance_name
+            for instance_name in self.source_instances
+            if instance_name not in source_configs
+        ]
+
+        print(
+            f"{len(self.source_instances) - len(instance_names)} of {len(self.source_instances)} "
+            f"source instances are already in {self.mig_name} MIG, "
+            f"{len(instance_names)} instances will be migrated"
+        )
+        print("==========")
+
+        return instance_names
+
+    def _get_mig(self) -> compute_v1.InstanceGroupManager:
+        if self.zone:
+            return instance_group_managers_client.get(
+                project=self.project,
+                zone=self.zone,
+                instance_group_manager=self.mig_name,
+            )
+
+        return region_instance_group_managers_client.get(
+            project=self.project,
+            region=self.region,
+            instance_group_manager=self.mig_name,
+        )
+
+    def _load_mig_template(self) -> None:
+        mig = self._get_mig()
+
+        template_name = mig.instance_template.split("/")[-1]
+        template = instance_templates_client.get(
+            project=self.project, instance_template=template_name,
+        )
+
+        self.template_metadata = {
+            item.key: item.value for item in template.properties.metadata.items
+        }
+
+        print(f"Using MIG {self.mig_name} with instance template {template_name}")
+        print("==========")
+
+    def _verify_instance(
+        self,
+        instance_name: str,
+        config: typing.Optional[compute_v1.PerInstanceConfig],
+        managed_instance_links: typing.Dict[str, str],
+    ) -> typing.List[str]:
+        if config is None:
+            return ["no instance of the MIG was migrated from it"]
+
+        new_instance_name = config.name
+        new_instance_link = managed_instance_links.get(new_instance_name)
+
+        if not new_instance_link:
+            return [f"instance {new_instance_name} is not a member of the MIG"]
+
+        source_instance = self._get_instance(instance_name, self.source_instance_zone)
+        new_instance_zone = self._parse_instance_zone_from_link(new_instance_link)
+
+        new_instance = instance_client.get(
+            project=self.project, zone=new_instance_zone, instance=new_instance_name,
+        )
+
+        deadline = time.time() + VERIFY_STATUS_TIMEOUT
+
+        while (
+            new_instance.status
+            in (
+                compute_v1.Instance.Status.PROVISIONING.name,
+                compute_v1.Instance.Status.STAGING.name,
+            )
+            and time.time() < deadline
+        ):
+            time.sleep(5)
+            new_instance = instance_client.get(
+                project=self.project,
+                zone=new_instance_zone,
+                instance=new_instance_name,
+            )
+
+        problems = []
+
+        if new_instance.status != compute_v1.Instance.Status.RUNNING.name:
+            problems.append(f"status is {new_instance.status}, expected RUNNING")
+
+        attached_disks = {
+            disk.device_name: disk.source.split("/")[-1] for disk in new_instance.disks
+        }
 
+        # The expected disks are taken from the per-instance config, so members
+        # created by earlier versions of the script or by hand are checked too
+        preserved_disks = {
+            device_name: preserved_disk.source.split("/")[-1]
+            for device_name, preserved_disk in config.preserved_state.disks.items()
+        }
+
+        for disk in source_instance.data_disks:
+            expected_disk_name = preserved_disks.get(disk.device_name)
+            attached_disk_name = attached_disks.get(disk.device_name)
+
+            if expected_disk_name is None:
+                problems.append(
+                    f"disk {disk.device_name} is not preserved in the per-instance config"
+                )
+            elif attached_disk_name is None:
+                problems.append(f"no disk is attached as {disk.device_name}")
+            elif attached_disk_name != expected_disk_name:
+                problems.append(
+                    f"disk {attached_disk_name} is attached as {disk.device_name}, expected {expected_disk_name}"
+                )
+
+        if self.region:
+            # Regional disks can only be attached in their replica zones
+            for disk in new_instance.disks:
+                if "/regions/" not in disk.source:
                     continue
 
-                # We should remove all disks (except boot disk) from template
-                base_disk_configs.append(
-                    {
-                        "device_name": disk.device_name,
-                        "instantiate_from": "DO_NOT_INCLUDE",
-                    }
+                disk_object = region_disks_client.get(
+                    project=self.project,
+                    region=self._parse_disk_region_from_source(disk.source),
+                    disk=disk.source.split("/")[-1],
                 )
+                replica_zones = [
+                    zone.split("/")[-1] for zone in disk_object.replica_zones
+                ]
+
+                if new_instance_zone not in replica_zones:
+                    problems.append(
+                        f"instance is in zone {new_instance_zone}, "
+                        f"but disk {disk_object.name} is replicated in {', '.join(replica_zones)}"
+                    )
+
+        new_metadata = {item.key: item.value for item in new_instance.metadata.items}
+
+        for key, value in source_instance.metadata:
+            if key not in new_metadata:
+                problems.append(f"metadata key {key} is missing")
+            elif new_metadata[key] != value:
+                problems.append(f"metadata key {key} differs from the source instance")
+
+        return problems
+
+    def _verify_instance_safely(
+        self,
+        instance_name: str,
+        config: typing.Optional[compute_v1.PerInstanceConfig],
+        managed_instance_links: typing.Dict[str, str],
+    ) -> typing.List[str]:
+        try:
+            return self._verify_instance(instance_name, config, managed_instance_links)
+        except Exception as err:
+            # Also connection errors left after all retries, so one instance
+            # doesn't stop the verification of the others
+            return [f"verification failed: {err}"]
+
+    def verify(
+        self, instance_names: typing.List[str] = None
+    ) -> typing.Dict[str, typing.List[str]]:
+        # Checks every new MIG member against its source instance and returns
+        # the problems found for every source instance (empty list if passed)
+        if instance_names is None:
+            instance_names = self.source_instances
+
+        print(f"Verifying {len(instance_names)} instances in {self.mig_name} MIG ...")
+
+        # Configs that don't match any of the source instances aren't verified
+        source_configs, _ = self._map_configs_to_sources()
+        managed_instance_links = {
+            managed_instance.instance.split("/")[-1]: managed_instance.instance
+            for managed_instance in self._list_managed_instances()
+        }
+
+        with concurrent.futures.ThreadPoolExecutor(self.verify_workers) as executor:
+            report = dict(
+                zip(
+                    instance_names,
+                    executor.map(
+                        lambda instance_name: self._verify_instance_safely(
+                            instance_name,
+                            source_configs.get(instance_name),
+                            managed_instance_links,
+                        ),
+                        instance_names,
+                    ),
+                )
+            )
+
+        for instance_name, problems in report.items():
+            config = source_configs.get(instance_name)
+            mapping = f"{instance_name} -> {config.name}" if config else instance_name
 
-            print("Creating base instance template ...")
-            base_instance_template_name = self._create_instance_template(
-                base_disk_configs
+            if problems:
+                print(f"* FAIL {mapping}: {'; '.join(problems)}")
+            else:
+                print(f"* PASS {mapping}")
+
+        failed = sum(1 for problems in report.values() if problems)
+        print(
+            f"Verification finished: {len(report) - failed} passed, {failed} failed"
+        )
+        print("==========")
+
+        return report
+
+    def _snapshot_disk(
+        self,
+        disk_name: str,
+        disk_zone: str,
+        disk_region: str,
+        rate_limiter: RateLimiter,
+    ) -> str:
+        # The disk name is cut short so the snapshot name fits, and is passed
+        # in full, so disks with the same beginning get different snapshots
+        suffix = "-snapshot"
+        max_prefix_length = MAX_RESOURCE_NAME_LENGTH - len(suffix) - len("-000000")
+        snapshot_name = self._build_resource_name(
+            disk_name[:max_prefix_length].rstrip("-") + suffix, disk_name
+        )
+
+        try:
+            if disk_zone:
+                self._run_operation(
+                    f"create snapshot {snapshot_name}",
+                    lambda request_id: disks_client.create_snapshot_unary(
+                        request=compute_v1.CreateSnapshotDiskRequest(
+                            project=self.project,
+                            zone=disk_zone,
+                            disk=disk_name,
+                            snapshot_resource={"name": snapshot_name},
+                            request_id=request_id,
+                        )
+                    ),
+                    zone=disk_zone,
+                    rate_limiter=rate_limiter,
+                )
+            else:
+                self._run_operation(
+                    f"create snapshot {snapshot_name}",
+                    lambda request_id: region_disks_client.create_snapshot_unary(
+                        request=compute_v1.CreateSnapshotRegionDiskRequest(
+                            project=self.project,
+                            region=disk_region,
+                            disk=disk_name,
+                            snapshot_resource={"name": snapshot_name},
+                            request_id=request_id,
+                        )
+                    ),
+                    region=disk_region,
+                    rate_limiter=rate_limiter,
+                )
+        except google.api_core.exceptions.Conflict:
+            # The snapshot was created by a previous decommission run
+            pass
+
+        return snapshot_name
+
+    def _delete_disk(
+        self,
+        disk_name: str,
+        disk_zone: str,
+        disk_region: str,
+        rate_limiter: RateLimiter,
+    ) -> None:
+        if disk_zone:
+            self._run_operation(
+                f"delete disk {disk_name}",
+                lambda request_id: disks_client.delete_unary(
+                    request=compute_v1.DeleteDiskRequest(
+                        project=self.project,
+                        zone=disk_zone,
+                        disk=disk_name,
+                        request_id=request_id,
+                    )
+                ),
+                zone=disk_zone,
+                rate_limiter=rate_limiter,
             )
-            self.created_artifacts.append(
-                {
-                    "key": "instance_template",
-                    "name": base_instance_template_name,
-                    "priority": 2,
-                }
+        else:
+            self._run_operation(
+                f"delete disk {disk_name}",
+                lambda request_id: region_disks_client.delete_unary(
+                    request=compute_v1.DeleteRegionDiskRequest(
+                        project=self.project,
+                        region=disk_region,
+                        disk=disk_name,
+                        request_id=request_id,
+                    )
+                ),
+                region=disk_region,
+                rate_limiter=rate_limiter,
+            )
+
+    def _decommission_instance(
+        self,
+        instance_name: str,
+        snapshot_disks: bool,
+        limiter: AdaptiveConcurrencyLimiter,
+        rate_limiter: RateLimiter,
+    ) -> DecommissionResult:
+        result = DecommissionResult(instance_name)
+        instance = self._get_instance(instance_name, self.source_instance_zone)
+
+        if instance.status != compute_v1.Instance.Status.TERMINATED.name:
+            raise RuntimeError(
+                f"instance is {instance.status}, expected TERMINATED"
             )
-            print(f"Instance template {base_instance_template_name} created")
-            print("==========")
 
-            # Step 3. Create an empty MIG
+        disks = []
+
+        for disk in instance.disks:
+            disk_name = disk.source.split("/")[-1]
+
+            if "/regions/" in disk.source:
+                disk_zone = None
+                disk_region = self._parse_disk_region_from_source(disk.source)
+                disk_object = region_disks_client.get(
+                    project=self.project, region=disk_region, disk=disk_name,
+                )
+            else:
+                disk_zone = self._parse_disk_zone_from_source(disk.source)
+                disk_region = None
+                disk_object = disks_client.get(
+                    project=self.project, zone=disk_zone, disk=disk_name,
+                )
+
+            disks.append((disk, disk_name, disk_zone, disk_region))
+            result.reclaimed_gb += disk_object.size_gb
+
+        if snapshot_disks:
+            for disk, disk_name, disk_zone, disk_region in disks:
+                result.snapshots.append(
+                    self._snapshot_disk(disk_name, disk_zone, disk_region, rate_limiter)
+                )
 
-            print(f"Creating empty MIG {self.mig_name}...")
-            self._create_empty_mig(base_instance_template_name)
-            self.created_artifacts.append(
-                {"key": "mig", "name": self.mig_name, "priority": 1}
+        self._run_operation(
+            f"delete instance {instance_name}",
+            lambda request_id: instance_client.delete_unary(
+                request=compute_v1.DeleteInstanceRequest(
+                    project=self.project,
+                    zone=self.source_instance_zone,
+                    instance=instance_name,
+                    request_id=request_id,
+                )
+            ),
+            zone=self.source_instance_zone,
+            limiter=limiter,
+            rate_limiter=rate_limiter,
+        )
+
+        for disk, disk_name, disk_zone, disk_region in disks:
+            # Auto-delete disks are deleted together with the instance
+            if not disk.auto_delete:
+                try:
+                    self._delete_disk(disk_name, disk_zone, disk_region, rate_limiter)
+                except google.api_core.exceptions.NotFound:
+                    pass
+
+            result.deleted_disks.append(disk_name)
+
+        locked_print(f"Instance {instance_name} and its {len(disks)} disks deleted")
+
+        return result
+
+    def _decommission_instance_safely(
+        self,
+        instance_name: str,
+        snapshot_disks: bool,
+        limiter: AdaptiveConcurrencyLimiter,
+        rate_limiter: RateLimiter,
+    ) -> DecommissionResult:
+        # Any failure, including a connection error left after all retries, is
+        # recorded in the report instead of stopping the other instances
+        try:
+            return self._decommission_instance(
+                instance_name, snapshot_disks, limiter, rate_limiter
+            )
+        except Exception as err:
+            result = DecommissionResult(instance_name)
+            result.error = str(err)
+            locked_print(f"Failed to decommission instance {instance_name}: {err}")
+            return result
+
+    def decommission(
+        self, delete_workers: int, delete_rate: float, snapshot_disks: bool = False
+    ) -> typing.Dict[str, DecommissionResult]:
+        # Deletes the source instances that pass the verification together with
+        # their disks, and returns the result for every verified source instance
+        self.concurrency_limiters = []
+        start_time = time.time()
+
+        verification_report = self.verify()
+        instance_names = [
+            instance_name
+            for instance_name, problems in verification_report.items()
+            if not problems
+        ]
+        skipped = len(verification_report) - len(instance_names)
+
+        print(
+            f"Decommissioning {len(instance_names)} source instances with up to "
+            f"{delete_workers} workers and {delete_rate:g} operations per second"
+            + (", snapshotting their disks first" if snapshot_disks else "")
+        )
+        print("==========")
+
+        limiter = AdaptiveConcurrencyLimiter("decommissions", delete_workers)
+        rate_limiter = RateLimiter(delete_rate, burst=max(1, int(delete_rate)))
+
+        report = dict(
+            zip(
+                instance_names,
+                self._run_with_limiter(
+                    limiter,
+                    lambda instance_name: self._decommission_instance_safely(
+                        instance_name, snapshot_disks, limiter, rate_limiter
+                    ),
+                    instance_names,
+                ),
             )
-            print(f"MIG {self.mig_name} created")
-            print("==========")
+        )
 
-            # Step 4. Add instances to MIG one by one
+        print("==========")
+        self._print_concurrency_history()
 
-            for instance_name in self.source_instances:
-                instance = self._get_instance(instance_name, self.source_instance_zone)
+        print("Decommission report:")
 
-                new_disks_config = {}
+        for instance_name, result in report.items():
+            if result.error:
+                print(f"* FAILED {instance_name}: {result.error}")
+            else:
+                print(
+                    f"* DELETED {instance_name}: "
+                    f"disks {', '.join(result.deleted_disks)}"
+                    + (
+                        f"; snapshots {', '.join(result.snapshots)}"
+                        if result.snapshots
+                        else ""
+                    )
+                )
 
-                for disk in instance.disks:
-                    # boot disk will be created from template
-                    if disk.boot:
-                        continue
+        for instance_name, problems in verification_report.items():
+            if problems:
+                print(f"* SKIPPED {instance_name}: failed verification")
 
-                    new_disk_name = f"{disk.device_name}-{uuid.uuid4().hex[:6]}"
+        deleted = [result for result in report.values() if not result.error]
+        print(
+            f"Decommission finished: {len(deleted)} deleted, "
+            f"{len(report) - len(deleted)} failed, {skipped} skipped. "
+            f"{sum(result.reclaimed_gb for result in deleted)} GB of disks reclaimed "
+            f"in {int(time.time() - start_time)} seconds."
+        )
+        print("==========")
+
+        return report
+
+    def _print_concurrency_history(self) -> None:
+        if not self.concurrency_limiters:
+            return
 
-                    print(f"Creating disk {new_disk_name} from disk {disk.device_name}")
+        print("Concurrency over time:")
+
+        for limiter in self.concurrency_limiters:
+            print(f"* {limiter.name}: {limiter.format_history()}")
+        print("==========")
+
+    def _print_cleanup_commands(self) -> None:
+        print("\nTo revert all changes, use this clean up commands:")
+
+        for artifact in self.created_artifacts.in_cleanup_order():
+            if artifact.kind == "mig_instance":
+                print(
+                    f"* gcloud compute instance-groups managed delete-instances {self.mig_name} --instances={artifact.name}"
+                )
+
+            if artifact.kind == "instance_template":
+                print(f"* gcloud compute instance-templates delete {artifact.name}")
+
+            if artifact.kind == "disk":
+                print(f"* gcloud compute disks delete {artifact.name}")
+
+            if artifact.kind == "mig":
+                print(f"* gcloud compute instance-groups managed delete {artifact.name}")
+
+            if artifact.kind == "image":
+                print(f"* gcloud compute images delete {artifact.name}")
+        print()
+
+    def _create_base_instance_template(self) -> str:
+        self.template_metadata = dict(self.base_instance.metadata)
+        base_disk_configs = []
+
+        for disk in self.base_instance.disks:
+            if disk.boot:
+                if self.image_for_boot_disk:
+                    print(f"Creating disk image for boot image {disk.device_name} ...")
+                    image_name = self._create_image_for_disk(disk)
+                    print(f"Disk image {image_name} created")
                     print("==========")
 
-                    if self.zone:
-                        disk_zone = self._parse_disk_zone_from_source(disk.source)
+                    self.created_artifacts.add("image", image_name)
 
-                        operation = disks_client.insert_unary(
-                            project=self.project,
-                            zone=disk_zone,
-                            disk_resource={
-                                "source_disk": self._build_disk_link(
-                                    disk.device_name, disk_zone
-                                ),
-                                "name": new_disk_name,
-                            },
-                        )
+                    base_disk_configs.append(
+                        {
+                            "device_name": disk.device_name,
+                            "custom_image": self._build_image_link(image_name),
+                            "instantiate_from": "CUSTOM_IMAGE",
+                        }
+                    )
 
-                        self._wait_for_operation(operation, disk_zone)
+                continue
 
-                        self.created_artifacts.append(
-                            {"key": "disk", "name": new_disk_name, "priority": 3}
-                        )
+            # We should remove all disks (except boot disk) from template
+            base_disk_configs.append(
+                {
+                    "device_name": disk.device_name,
+                    "instantiate_from": "DO_NOT_INCLUDE",
+                }
+            )
 
-                        new_disks_config[
-                            new_disk_name
-                        ] = compute_v1.PreservedStatePreservedDisk(
-                            source=self._build_disk_link(new_disk_name, disk_zone)
-                        )
+        print("Creating base instance template ...")
+        base_instance_template_name = self._create_instance_template(
+            base_disk_configs
+        )
+        self.created_artifacts.add("instance_template", base_instance_template_name)
+        print(f"Instance template {base_instance_template_name} created")
+        print("==========")
 
-                    if self.region:
-                        disk_region = self._parse_disk_region_from_source(disk.source)
+        return base_instance_template_name
 
-                        disk_object = region_disks_client.get(
-                            project=self.project,
-                            region=disk_region,
-                            disk=disk.device_name,
-                        )
+    def migrate(self) -> bool:
+        # Returns whether the migration finished and all new instances passed
+        # the verification
+        self.created_artifacts = ArtifactRegistry()
+        self.progress = ProgressReporter(len(self.source_instances), self.progress_fd)
+        self.concurrency_limiters = []
+        self.region_zones = []
 
-                        operation = region_disks_client.insert_unary(
-                            project=self.project,
-                            region=disk_region,
-                            disk_resource={
-                                "source_disk": self._build_region_disk_link(
-                                    disk.device_name, disk_region
-                                ),
-                                "name": new_disk_name,
-                                "replica_zones": disk_object.replica_zones,
-                            },
-                        )
+        try:
+            script_start_time = time.time()
+            self.progress.started()
 
-                        self._wait_for_operation(
-                            operation, zone=None, region=disk_region
-                        )
-                        self.created_artifacts.append(
-                            {"key": "disk", "name": new_disk_name, "priority": 3}
-                        )
+            instance_names = self.source_instances
 
-                        new_disks_config[
-                            new_disk_name
-                        ] = compute_v1.PreservedStatePreservedDisk(
-                            source=self._build_region_disk_link(
-                                new_disk_name, disk_region
-                            )
-                        )
+            if self.append:
+                # Step 0. Find the source instances that aren't in the MIG yet
+
+                instance_names = self._find_unmigrated_instances()
+                self.progress.total_instances = len(instance_names)
+
+                if not instance_names:
+                    print(
+                        f"All source instances are already migrated to {self.mig_name} MIG"
+                    )
+                    self.progress.finished()
+                    return True
+            else:
+                self.base_instance = self._get_instance(
+                    self.base_instance_name, self.source_instance_zone
+                )
+
+            # Step 1. Read source instances and plan disk clones
+
+            with concurrent.futures.ThreadPoolExecutor(READ_WORKERS) as executor:
+                source_instances = dict(
+                    zip(
+                        instance_names,
+                        executor.map(
+                            lambda instance_name: self._get_instance(
+                                instance_name, self.source_instance_zone
+                            ),
+                            instance_names,
+                        ),
+                    )
+                )
+
+                # boot disk will be created from template
+                clone_jobs = list(
+                    executor.map(
+                        lambda instance_disk: self._plan_disk_clone(*instance_disk),
+                        [
+                            (instance_name, disk)
+                            for instance_name in instance_names
+                            for disk in source_instances[instance_name].data_disks
+                        ],
+                    )
+                )
+
+            if self.stateful_policy:
+                self._check_stateful_policy(source_instances)
+
+            self._check_disk_types(clone_jobs)
+
+            self._check_disk_quota(clone_jobs)
+
+            if self.region:
+                self._check_instance_zones(instance_names, clone_jobs)
+
+            for clone_job in clone_jobs:
+                self.progress.add_disk_gb(clone_job.size_gb)
+
+            for instance_name in instance_names:
+                if not source_instances[instance_name].data_disks:
+                    self.progress.instance_cloned(instance_name)
+
+            instances_to_stop = sum(
+                1
+                for instance in source_instances.values()
+                if instance.status != compute_v1.Instance.Status.TERMINATED.name
+            )
+            _, predicted_clone_seconds = clone_scheduler.plan_longest_job_first(
+                clone_jobs,
+                AdaptiveConcurrencyLimiter.initial_limit(self.clone_workers),
+            )
+            self.progress.plan(
+                instances_to_stop,
+                STOP_SECONDS * math.ceil(instances_to_stop / self.stop_workers),
+                predicted_clone_seconds,
+                INSERT_SECONDS * math.ceil(len(instance_names) / self.add_workers),
+            )
+
+            # Step 2. Stop all instances
+
+            stop_limiter = AdaptiveConcurrencyLimiter(
+                "instance stops", self.stop_workers
+            )
+            self._run_with_limiter(
+                stop_limiter,
+                lambda instance_name: self._stop_source_instance(
+                    source_instances[instance_name], stop_limiter
+                ),
+                instance_names,
+            )
+
+            if self.append:
+                # Steps 3 and 4. Reuse the instance template and the MIG
+
+                self._load_mig_template()
+            else:
+                # Step 3. Create an instance template from the base instance
 
-                metadata = []
+                base_instance_template_name = self._create_base_instance_template()
 
-                for item in instance.metadata.items:
-                    metadata.append([item.key, item.value])
+                # Step 4. Create an empty MIG
 
-                new_instance_name = f"{instance_name}-{uuid.uuid4().hex[:6]}"
+                print(f"Creating empty MIG {self.mig_name}...")
+                self._create_empty_mig(base_instance_template_name)
+                self.created_artifacts.add("mig", self.mig_name)
+                print(f"MIG {self.mig_name} created")
+                print("==========")
 
-                print(f"Adding instance {new_instance_name} to {self.mig_name} MIG")
-                print("==========\n")
+            # Step 5. Clone data disks of all instances, longest clones first
 
-                self._add_instance_to_mig(new_instance_name, new_disks_config, metadata)
+            new_disks_configs = self._clone_disks(clone_jobs)
+
+            # Step 6. Add instances to MIG
+
+            add_limiter = AdaptiveConcurrencyLimiter("MIG additions", self.add_workers)
+            self._run_with_limiter(
+                add_limiter,
+                lambda instance_name: self._add_source_instance_to_mig(
+                    source_instances[instance_name],
+                    new_disks_configs.get(instance_name, {}),
+                    add_limiter,
+                ),
+                instance_names,
+            )
+
+            self.progress.finished()
+            self._print_concurrency_history()
+
+            if self.region:
+                self._print_zone_counts()
+
+            # Step 7. Verify the new MIG members against the source instances
+
+            verification_report = self.verify(instance_names)
 
             script_end_time = time.time()
 
             script_diff_time = script_end_time - script_start_time
 
+            failed_instances = [
+                instance_name
+                for instance_name, problems in verification_report.items()
+                if problems
+            ]
+
+            if failed_instances:
+                print(
+                    f"Migration finished, but {len(failed_instances)} instances failed verification: "
+                    f"{' '.join(failed_instances)}. Time spent: {int(script_diff_time)} seconds."
+                )
+                self._print_cleanup_commands()
+                return False
+
             print(
                 f"Migration successfully finished. Time spent: {int(script_diff_time)} seconds."
             )
-            # Step 4. Print console commands for clean up
+            # Step 8. Print console commands for clean up
 
             # Clean source instances
             print(
                 "Use the following command to delete the individual source instances:"
             )
             print(
-                f'* gcloud compute instances delete {" ".join(self.source_instances)}'
+                f'* gcloud compute instances delete {" ".join(instance_names)}'
+            )
+            print(
+                "Or delete the verified source instances together with their disks:"
+            )
+            print(
+                f"* python3 decommission_script.py -p {self.project} "
+                f'-s {" ".join(instance_names)} -z {self.source_instance_zone} '
+                f"-m {self.mig_name}" + (" --regional" if self.region else "")
             )
 
             self._print_cleanup_commands()
@@ -446,14 +1786,23 @@ class StatefulMIGMigrator:
             print(
                 "- Configuring autohealing: https://cloud.google.com/compute/docs/tutorials/migrate-workload-to-stateful-mig#configuring_autohealing"
             )
-            print("- Using a stateful policy instead of per-instance configurations:")
-            print(
-                "  https://cloud.google.com/compute/docs/tutorials/migrate-workload-to-stateful-mig#using_a_stateful_policy_instead_of_per-instance_configurations"
-            )
+            if not self.stateful_policy:
+                print(
+                    "- Using a stateful policy instead of per-instance configurations:"
+                )
+                print(
+                    "  https://cloud.google.com/compute/docs/tutorials/migrate-workload-to-stateful-mig#using_a_stateful_policy_instead_of_per-instance_configurations"
+                )
             print("- Adding more VMs:")
             print(
                 "  https://cloud.google.com/compute/docs/tutorials/migrate-workload-to-stateful-mig#adding_more_vms"
             )
+
+            return True
         except Exception as err:
+            self.progress.finished(err)
+            self._print_concurrency_history()
             print(f"Script failed during the execution. Reason: {err}")
             self._print_cleanup_commands()
+
+            return False
@@ -0,0 +1,70 @@
+import typing
+
+import pytest
+
+import clone_scheduler
+from migration_records import DiskClone
+
+
+def make_jobs(estimated_seconds: typing.List[float]) -> typing.List[DiskClone]:
+    jobs = []
+
+    for index, seconds in enumerate(estimated_seconds):
+        job = DiskClone(f"instance-{index}", "data", f"disk-{index}")
+        job.estimated_seconds = seconds
+        jobs.append(job)
+
+    return jobs
+
+
+def test_estimate_clone_seconds() -> None:
+    assert clone_scheduler.estimate_clone_seconds(100, "pd-ssd") == 10 + 100 * 0.5
+    assert clone_scheduler.estimate_clone_seconds(100, "pd-standard") == 10 + 100 * 2
+    assert clone_scheduler.estimate_clone_seconds(100, "unknown") == 10 + 100 * 2
+
+
+def test_longest_jobs_are_planned_first() -> None:
+    jobs = make_jobs([30, 120, 60, 10])
+
+    ordered_jobs, _ = clone_scheduler.plan_longest_job_first(jobs, 2)
+
+    assert [job.estimated_seconds for job in ordered_jobs] == [120, 60, 30, 10]
+
+
+def test_predicted_finish_times() -> None:
+    jobs = make_jobs([30, 120, 60, 10])
+
+    ordered_jobs, predicted_duration = clone_scheduler.plan_longest_job_first(
+        jobs, 2
+    )
+
+    # 120 runs alone on one worker, 60, 30 and 10 follow each other on the other
+    assert [job.predicted_finish for job in ordered_jobs] == [120, 60, 90, 100]
+    assert predicted_duration == 120
+
+
+def test_single_worker_runs_jobs_back_to_back() -> None:
+    jobs = make_jobs([5, 20, 10])
+
+    ordered_jobs, predicted_duration = clone_scheduler.plan_longest_job_first(
+        jobs, 1
+    )
+
+    assert [job.predicted_finish for job in ordered_jobs] == [20, 30, 35]
+    assert predicted_duration == 35
+
+
+def test_more_workers_than_jobs() -> None:
+    jobs = make_jobs([40, 20])
+
+    ordered_jobs, predicted_duration = clone_scheduler.plan_longest_job_first(
+        jobs, 8
+    )
+
+    assert [job.predicted_finish for job in ordered_jobs] == [40, 20]
+    assert predicted_duration == 40
+
+
+@pytest.mark.parametrize("workers", [0, 1, 4])
+def test_no_jobs(workers: int) -> None:
+    assert clone_scheduler.plan_longest_job_first([], workers) == ([], 0.0)
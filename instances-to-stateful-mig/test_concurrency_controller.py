@@ -0,0 +1,201 @@
+import concurrent.futures
+import threading
+import time
+import typing
+
+import pytest
+
+import concurrency_controller
+from concurrency_controller import (
+    AdaptiveConcurrencyLimiter,
+    RateLimiter,
+    run_with_limiter,
+)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch: typing.Any) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(concurrency_controller, "time", fake_clock)
+    return fake_clock
+
+
+@pytest.mark.parametrize(
+    "max_limit, min_limit, initial_limit", [(8, 1, 4), (1, 1, 1), (3, 1, 1), (4, 3, 3)]
+)
+def test_initial_limit(max_limit: int, min_limit: int, initial_limit: int) -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", max_limit, min_limit)
+
+    assert (
+        AdaptiveConcurrencyLimiter.initial_limit(max_limit, min_limit) == initial_limit
+    )
+    assert limiter.limit == initial_limit
+
+
+def test_limit_grows_by_one_per_window_of_successes(clock: FakeClock) -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 8)
+
+    for _ in range(4):
+        limiter.record_latency(10)
+
+    assert int(limiter.limit) == 5
+
+    for _ in range(5):
+        limiter.record_latency(10)
+
+    assert int(limiter.limit) == 6
+    assert [limit for _, limit in limiter.history] == [4, 5, 6]
+
+
+def test_limit_doesnt_grow_above_maximum(clock: FakeClock) -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 4)
+
+    for _ in range(20):
+        limiter.record_latency(10)
+
+    assert limiter.limit == 4
+
+
+def test_slow_operation_halves_limit(clock: FakeClock) -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 8)
+    limiter.record_latency(10)
+
+    limiter.record_latency(25)
+
+    assert int(limiter.limit) == 2
+
+
+def test_error_halves_limit_down_to_minimum(clock: FakeClock) -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 8, min_limit=2)
+    limiter.record_latency(10)
+
+    for _ in range(5):
+        clock.now += 60
+        limiter.record_error(RuntimeError("failed"))
+
+    assert limiter.limit == 2
+
+
+def test_one_decrease_per_baseline_latency(clock: FakeClock) -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 16)
+    # A large clone: 300 seconds, but only 1 second per unit of cost
+    limiter.record_latency(300, cost=300)
+
+    for _ in range(10):
+        clock.now += 1
+        limiter.record_error(RuntimeError("failed"))
+
+    assert int(limiter.limit) == 4
+
+    clock.now += 300
+    limiter.record_error(RuntimeError("failed"))
+
+    assert int(limiter.limit) == 2
+
+
+def test_large_operation_isnt_slow(clock: FakeClock) -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 8)
+    limiter.record_latency(10, cost=10)
+
+    limiter.record_latency(500, cost=400)
+
+    assert int(limiter.limit) == 4
+
+
+def test_rate_limiter_allows_burst_then_spaces_operations(clock: FakeClock) -> None:
+    rate_limiter = RateLimiter(5, burst=3)
+
+    for _ in range(3):
+        rate_limiter.acquire()
+
+    assert clock.sleeps == []
+
+    start_time = clock.now
+
+    for _ in range(10):
+        rate_limiter.acquire()
+
+    assert clock.now - start_time == pytest.approx(10 / 5)
+
+
+def test_rate_limiter_refills_while_idle(clock: FakeClock) -> None:
+    rate_limiter = RateLimiter(2, burst=2)
+    rate_limiter.acquire()
+    rate_limiter.acquire()
+
+    clock.now += 10
+
+    rate_limiter.acquire()
+    rate_limiter.acquire()
+
+    assert clock.sleeps == []
+
+
+def test_run_with_limiter_starts_items_in_order() -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 2)
+    started = []
+
+    with concurrent.futures.ThreadPoolExecutor(limiter.max_limit) as executor:
+        futures = run_with_limiter(
+            limiter, lambda item: started.append(item) or item * 2, range(6), executor
+        )
+        results = [future.result() for future in futures]
+
+    assert results == [0, 2, 4, 6, 8, 10]
+    # Only one item runs at a time with the starting limit of 1
+    assert started == [0, 1, 2, 3, 4, 5]
+
+
+def test_run_with_limiter_respects_limit() -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 4)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def run_item(item: int) -> None:
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+
+        time.sleep(0.01)
+
+        with lock:
+            running[0] -= 1
+
+    with concurrent.futures.ThreadPoolExecutor(limiter.max_limit) as executor:
+        futures = run_with_limiter(limiter, run_item, range(20), executor)
+        concurrent.futures.wait(futures)
+
+    assert len(futures) == 20
+    assert max_running[0] <= 2
+
+
+def test_run_with_limiter_stops_after_failure() -> None:
+    limiter = AdaptiveConcurrencyLimiter("test", 1)
+
+    def run_item(item: int) -> int:
+        if item == 2:
+            raise RuntimeError("failed")
+        return item
+
+    with concurrent.futures.ThreadPoolExecutor(limiter.max_limit) as executor:
+        futures = run_with_limiter(limiter, run_item, range(6), executor)
+
+        assert len(futures) == 3
+        assert [future.result() for future in futures[:2]] == [0, 1]
+
+        with pytest.raises(RuntimeError):
+            futures[2].result()
@@ -0,0 +1,43 @@
+import pytest
+
+from migration_records import DiskRule
+
+
+def test_parse_disk_rule() -> None:
+    rule = DiskRule.parse("data:type=pd-extreme,size_gb=200,provisioned_iops=10000")
+
+    assert rule.device_name == "data"
+    assert rule.disk_type == "pd-extreme"
+    assert rule.size_gb == 200
+    assert rule.provisioned_iops == 10000
+
+
+def test_parse_disk_rule_with_one_option() -> None:
+    rule = DiskRule.parse("*:size_gb=500")
+
+    assert rule.device_name == "*"
+    assert rule.disk_type is None
+    assert rule.size_gb == 500
+    assert rule.provisioned_iops is None
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "data",
+        "data:",
+        ":type=pd-ssd",
+        "data:foo=1",
+        "data:type",
+        "data:type=",
+        "data:type=pd-ssd,,size_gb=10",
+    ],
+)
+def test_parse_invalid_disk_rule(value: str) -> None:
+    with pytest.raises(ValueError):
+        DiskRule.parse(value)
+
+
+def test_parse_disk_rule_with_invalid_number() -> None:
+    with pytest.raises(ValueError):
+        DiskRule.parse("data:size_gb=large")
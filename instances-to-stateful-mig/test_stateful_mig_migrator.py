@@ -0,0 +1,387 @@
+import argparse
+import typing
+
+import google.api_core.exceptions
+import google.cloud.compute_v1 as compute_v1
+import pytest
+
+from migration_records import ArtifactRegistry, DiskClone, SourceDisk, SourceInstance
+import stateful_mig_migrator
+from stateful_mig_migrator import StatefulMIGMigrator
+
+
+def make_migrator(**kwargs: typing.Any) -> StatefulMIGMigrator:
+    args = dict(
+        project="project",
+        source_instances=["instance-1", "instance-2"],
+        base_instance_name=None,
+        source_instance_zone="us-central1-a",
+        mig_name="mig",
+        regional=False,
+        append=False,
+        image_for_boot_disk=False,
+        stateful_policy=False,
+        disk_rules=[],
+        stop_workers=8,
+        clone_workers=4,
+        add_workers=4,
+        max_retries=3,
+        progress_fd=None,
+        verify_workers=16,
+    )
+    args.update(kwargs)
+    return StatefulMIGMigrator(argparse.Namespace(**args))
+
+
+def make_operation(*error_codes: str) -> compute_v1.Operation:
+    return compute_v1.Operation(
+        name="operation",
+        status=compute_v1.Operation.Status.DONE,
+        error=compute_v1.Error(
+            errors=[
+                compute_v1.Errors(code=code, message="failed") for code in error_codes
+            ]
+        ),
+    )
+
+
+def make_instance(name: str, *data_device_names: str) -> SourceInstance:
+    disks = (SourceDisk("boot", f"zones/us-central1-a/disks/{name}", True, True),)
+    disks += tuple(
+        SourceDisk(
+            device_name,
+            f"zones/us-central1-a/disks/{name}-{device_name}",
+            False,
+            False,
+        )
+        for device_name in data_device_names
+    )
+    return SourceInstance(name, "RUNNING", name, disks, ())
+
+
+class FakeRequests:
+    # Returns or raises the given results one by one and records the request IDs
+    def __init__(self, *results: typing.Any) -> None:
+        self.results = list(results)
+        self.request_ids = []
+
+    def __call__(self, request_id: str) -> compute_v1.Operation:
+        self.request_ids.append(request_id)
+        result = self.results.pop(0)
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch: typing.Any) -> None:
+    monkeypatch.setattr(stateful_mig_migrator.time, "sleep", lambda seconds: None)
+
+
+def test_run_operation_succeeds() -> None:
+    send_request = FakeRequests(make_operation())
+
+    make_migrator()._run_operation("test", send_request)
+
+    assert len(send_request.request_ids) == 1
+
+
+def test_run_operation_resends_same_request_id_after_api_error() -> None:
+    send_request = FakeRequests(
+        google.api_core.exceptions.ServiceUnavailable("unavailable"),
+        ConnectionError("reset"),
+        make_operation(),
+    )
+
+    make_migrator()._run_operation("test", send_request)
+
+    assert len(send_request.request_ids) == 3
+    assert len(set(send_request.request_ids)) == 1
+
+
+def test_run_operation_restarts_failed_operation_with_new_request_id() -> None:
+    send_request = FakeRequests(
+        make_operation("RATE_LIMIT_EXCEEDED"), make_operation()
+    )
+
+    make_migrator()._run_operation("test", send_request)
+
+    assert len(send_request.request_ids) == 2
+    assert send_request.request_ids[0] != send_request.request_ids[1]
+
+
+def test_run_operation_raises_on_permanent_operation_error() -> None:
+    send_request = FakeRequests(
+        make_operation("RATE_LIMIT_EXCEEDED", "QUOTA_EXCEEDED"), make_operation()
+    )
+
+    with pytest.raises(RuntimeError, match="QUOTA_EXCEEDED"):
+        make_migrator()._run_operation("test", send_request)
+
+    assert len(send_request.request_ids) == 1
+
+
+def test_run_operation_raises_after_last_retry() -> None:
+    send_request = FakeRequests(
+        *[google.api_core.exceptions.ServiceUnavailable("unavailable")] * 3
+    )
+
+    with pytest.raises(google.api_core.exceptions.ServiceUnavailable):
+        make_migrator(max_retries=2)._run_operation("test", send_request)
+
+    assert len(send_request.request_ids) == 3
+
+
+def test_run_operation_without_retries() -> None:
+    send_request = FakeRequests(make_operation("INTERNAL_ERROR"), make_operation())
+
+    with pytest.raises(RuntimeError, match="INTERNAL_ERROR"):
+        make_migrator(max_retries=0)._run_operation("test", send_request)
+
+    assert len(send_request.request_ids) == 1
+
+
+def test_run_operation_conflict_on_retry_is_success() -> None:
+    send_request = FakeRequests(
+        google.api_core.exceptions.GatewayTimeout("timeout"),
+        google.api_core.exceptions.Conflict("already exists"),
+    )
+
+    make_migrator()._run_operation("test", send_request)
+
+    assert len(send_request.request_ids) == 2
+
+
+def test_run_operation_conflict_on_first_attempt_raises() -> None:
+    send_request = FakeRequests(google.api_core.exceptions.Conflict("already exists"))
+
+    with pytest.raises(google.api_core.exceptions.Conflict):
+        make_migrator()._run_operation("test", send_request)
+
+    assert len(send_request.request_ids) == 1
+
+
+def test_stateful_policy_covers_data_disks() -> None:
+    migrator = make_migrator(stateful_policy=True)
+    migrator.base_instance = make_instance("instance-1", "data", "logs")
+
+    migrator._check_stateful_policy(
+        {
+            "instance-1": migrator.base_instance,
+            "instance-2": make_instance("instance-2", "data"),
+        }
+    )
+
+
+def test_stateful_policy_misses_data_disk() -> None:
+    migrator = make_migrator(stateful_policy=True)
+    migrator.base_instance = make_instance("instance-1", "data")
+
+    with pytest.raises(RuntimeError, match=r"instance-2 \(logs\)"):
+        migrator._check_stateful_policy(
+            {
+                "instance-1": migrator.base_instance,
+                "instance-2": make_instance("instance-2", "data", "logs"),
+            }
+        )
+
+
+def make_config(name: str, **disk_sources: str) -> compute_v1.PerInstanceConfig:
+    return compute_v1.PerInstanceConfig(
+        name=name,
+        preserved_state=compute_v1.PreservedState(
+            disks={
+                device_name: compute_v1.PreservedStatePreservedDisk(source=source)
+                for device_name, source in disk_sources.items()
+            }
+        ),
+    )
+
+
+def find_config_source(
+    migrator: StatefulMIGMigrator,
+    config: compute_v1.PerInstanceConfig,
+    source_disk_owners: typing.Dict[str, str] = None,
+) -> typing.Optional[str]:
+    new_instance_sources = {
+        migrator._build_resource_name(instance_name): instance_name
+        for instance_name in migrator.source_instances
+    }
+    return migrator._find_config_source(
+        config, new_instance_sources, lambda: source_disk_owners or {}
+    )
+
+
+def test_config_source_by_hashed_name() -> None:
+    migrator = make_migrator()
+    config = make_config(migrator._build_resource_name("instance-2"))
+
+    assert find_config_source(migrator, config) == "instance-2"
+
+
+@pytest.mark.parametrize(
+    "config_name, instance_name",
+    [
+        ("web-1a2b3c", "web"),
+        ("web-2-1a2b3c", "web-2"),
+        ("web-2-1a2b3c4d", None),
+        ("web-backup-1a2b3c", None),
+    ],
+)
+def test_config_source_by_earlier_name(
+    config_name: str, instance_name: typing.Optional[str]
+) -> None:
+    migrator = make_migrator(source_instances=["web", "web-2"])
+    migrator._get_disk = lambda disk_link: compute_v1.Disk()
+
+    assert find_config_source(migrator, make_config(config_name)) == instance_name
+
+
+def test_config_source_isnt_guessed_from_similar_name() -> None:
+    # web-2 isn't among the source instances, so its member can't be mapped
+    migrator = make_migrator(source_instances=["web"])
+
+    assert find_config_source(migrator, make_config("web-2-1a2b3c")) is None
+
+
+def test_config_source_by_disk_lineage() -> None:
+    migrator = make_migrator()
+    migrator._get_disk = lambda disk_link: compute_v1.Disk(
+        source_disk="https://www.googleapis.com/compute/v1/projects/project/zones/"
+        "us-central1-a/disks/instance-2-data"
+    )
+    config = make_config(
+        "manual", data="projects/project/zones/us-central1-a/disks/manual-data"
+    )
+    source_disk_owners = {"zones/us-central1-a/disks/instance-2-data": "instance-2"}
+
+    assert find_config_source(migrator, config, source_disk_owners) == "instance-2"
+
+
+def test_config_source_by_preserved_source_disk() -> None:
+    # Instances created by hand can also keep the disk of the source instance
+    migrator = make_migrator()
+    migrator._get_disk = lambda disk_link: compute_v1.Disk()
+    config = make_config(
+        "manual", data="projects/project/zones/us-central1-a/disks/instance-1-data"
+    )
+    source_disk_owners = {"zones/us-central1-a/disks/instance-1-data": "instance-1"}
+
+    assert find_config_source(migrator, config, source_disk_owners) == "instance-1"
+
+
+def make_clone_job(migrator: StatefulMIGMigrator) -> DiskClone:
+    migrator.created_artifacts = ArtifactRegistry()
+    clone_job = DiskClone("instance-1", "data", "data-1a2b3c")
+    clone_job.zone = "us-central1-a"
+    clone_job.source_disk = migrator._build_disk_link(
+        "instance-1-data", clone_job.zone
+    )
+    clone_job.link = migrator._build_disk_link(clone_job.name, clone_job.zone)
+    return clone_job
+
+
+@pytest.fixture
+def existing_clone(monkeypatch: typing.Any) -> None:
+    def insert_unary(request: compute_v1.InsertDiskRequest) -> None:
+        raise google.api_core.exceptions.Conflict("already exists")
+
+    monkeypatch.setattr(
+        stateful_mig_migrator.disks_client, "insert_unary", insert_unary
+    )
+
+
+def test_existing_clone_of_same_disk_is_reused(existing_clone: None) -> None:
+    migrator = make_migrator()
+    clone_job = make_clone_job(migrator)
+    migrator._get_disk = lambda disk_link: compute_v1.Disk(
+        source_disk="https://www.googleapis.com/compute/v1/" + clone_job.source_disk
+    )
+
+    migrator._clone_disk(clone_job)
+
+    assert [
+        artifact.name for artifact in migrator.created_artifacts.in_cleanup_order()
+    ] == [clone_job.name]
+
+
+def test_existing_disk_of_other_source_fails(existing_clone: None) -> None:
+    migrator = make_migrator()
+    clone_job = make_clone_job(migrator)
+    migrator._get_disk = lambda disk_link: compute_v1.Disk(
+        source_disk="projects/project/zones/us-central1-a/disks/other"
+    )
+
+    with pytest.raises(RuntimeError, match="wasn't cloned"):
+        migrator._clone_disk(clone_job)
+
+
+def make_type_change(zone: str, region: str, disk_type: str) -> DiskClone:
+    clone_job = DiskClone("instance-1", "data", "data-1a2b3c")
+    clone_job.zone = zone
+    clone_job.region = region
+    clone_job.disk_type = "pd-standard"
+    clone_job.target_disk_type = disk_type
+    return clone_job
+
+
+@pytest.fixture
+def disk_types(monkeypatch: typing.Any) -> None:
+    def get_disk_type(**kwargs: str) -> compute_v1.DiskType:
+        if kwargs["disk_type"] not in ("pd-ssd", "pd-extreme"):
+            raise google.api_core.exceptions.NotFound("not found")
+        return compute_v1.DiskType(name=kwargs["disk_type"])
+
+    for client in ("disk_types_client", "region_disk_types_client"):
+        monkeypatch.setattr(
+            getattr(stateful_mig_migrator, client), "get", get_disk_type
+        )
+
+
+def test_available_disk_type(disk_types: None) -> None:
+    make_migrator()._check_disk_types(
+        [make_type_change("us-central1-a", None, "pd-ssd")]
+    )
+
+
+def test_unknown_disk_type(disk_types: None) -> None:
+    with pytest.raises(ValueError, match="pd-sdd isn't available"):
+        make_migrator()._check_disk_types(
+            [make_type_change("us-central1-a", None, "pd-sdd")]
+        )
+
+
+def test_zonal_disk_type_in_regional_mig(disk_types: None) -> None:
+    with pytest.raises(ValueError, match="can't be used for regional disks"):
+        make_migrator(regional=True)._check_disk_types(
+            [make_type_change(None, "us-central1", "pd-extreme")]
+        )
+
+
+def test_failed_decommission_is_recorded() -> None:
+    migrator = make_migrator()
+
+    def decommission_instance(*args: typing.Any) -> None:
+        raise ConnectionError("connection reset")
+
+    migrator._decommission_instance = decommission_instance
+
+    result = migrator._decommission_instance_safely("instance-1", False, None, None)
+
+    assert result.instance_name == "instance-1"
+    assert result.error == "connection reset"
+
+
+def test_failed_verification_is_recorded() -> None:
+    migrator = make_migrator()
+
+    def verify_instance(*args: typing.Any) -> None:
+        raise ConnectionError("connection reset")
+
+    migrator._verify_instance = verify_instance
+
+    assert migrator._verify_instance_safely("instance-1", None, {}) == [
+        "verification failed: connection reset"
+    ]